@@ -0,0 +1,51 @@
+"""
+Benchmark chart building in commodplot, comparing the default (validated) figure assembly
+against fast mode where traces are plain dicts loaded into the figure in one step.
+
+Run from the repository root with: python -m benchmarks.bench_commodplot
+"""
+import os
+import timeit
+
+import pandas as pd
+
+from commodplot import commodplot
+
+testdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test')
+
+
+def load_cl():
+    cl = pd.read_csv(os.path.join(testdir, 'test_cl.csv'), index_col=0, parse_dates=True, dayfirst=True)
+    return cl.dropna(how='all', axis=1)
+
+
+def daily_history(years=25):
+    """
+    Long daily history, similar to the series used in seasonal dashboards
+    """
+    dr = pd.date_range(end=pd.Timestamp.today().normalize(), periods=365 * years, freq='D')
+    return pd.Series(range(len(dr)), index=dr, name='Daily', dtype=float)
+
+
+def bench(name, func, number=3):
+    slow = min(timeit.repeat(lambda: func(fast=False), number=number, repeat=3)) / number
+    fast = min(timeit.repeat(lambda: func(fast=True), number=number, repeat=3)) / number
+    print('{:<30} default {:8.1f}ms   fast {:8.1f}ms   speedup {:5.2f}x'.format(name, slow * 1000, fast * 1000,
+                                                                                 slow / fast))
+
+
+def main():
+    cl = load_cl()
+    daily = daily_history()
+    cols = cl[cl.columns[-60:]]
+
+    bench('seas_line_plot (25yr daily)', lambda fast: commodplot.seas_line_plot(daily, fast=fast))
+    bench('line_plot (60 contracts)', lambda fast: commodplot.line_plot(cols, fast=fast))
+    bench('stacked_area_chart', lambda fast: commodplot.stacked_area_chart(cols, fast=fast))
+    bench('bar_chart', lambda fast: commodplot.bar_chart(cols, fast=fast))
+    bench('reindex_year_line_subplot', lambda fast: commodplot.reindex_year_line_subplot(
+        2, 2, [cl[cl.columns[-4:]]] * 4, fast=fast))
+
+
+if __name__ == '__main__':
+    main()
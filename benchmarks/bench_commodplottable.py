@@ -0,0 +1,35 @@
+"""
+Benchmark generate_table on a large position table, comparing the pandas Styler based output
+against the fast path which colours columns with numpy and builds the html directly.
+
+Run from the repository root with: python -m benchmarks.bench_commodplottable
+"""
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from commodplot import commodplottable
+
+
+def positions(rows=5000, cols=10):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(0, 1000, (rows, cols)), columns=['Pos{}'.format(i) for i in range(cols)])
+    df.index = ['Book{}'.format(i) for i in range(rows)]
+    return df
+
+
+def main():
+    for rows in [500, 5000]:
+        df = positions(rows)
+        accounting = list(df.columns[:5])
+        times = {}
+        for fast in [False, True]:
+            func = lambda: commodplottable.generate_table(df, precision=2, accounting_col_columns=accounting, fast=fast)
+            times[fast] = min(timeit.repeat(func, number=1, repeat=3))
+        print('{:>5} rows   styler {:8.1f}ms   fast {:8.1f}ms   speedup {:5.1f}x'.format(
+            rows, times[False] * 1000, times[True] * 1000, times[False] / times[True]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Load test of the dashboard server: concurrent viewers requesting a dashboard of seasonal charts,
+with and without conditional (If-None-Match) requests.
+
+Run from the repository root with: python -m benchmarks.bench_dashserver
+"""
+import os
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.bench_commodplot import load_cl
+from commodplot import commodplot
+from commodplot import dashserver
+
+
+def fetch(url, etag=None):
+    req = urllib.request.Request(url, headers={'If-None-Match': etag} if etag else {})
+    try:
+        with urllib.request.urlopen(req) as res:
+            return len(res.read())
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        return 0
+
+
+def load_test(url, viewers, requests, etag=None):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=viewers) as ex:
+        nbytes = sum(ex.map(lambda i: fetch(url, etag), range(requests)))
+    elapsed = time.perf_counter() - start
+    return requests / elapsed, nbytes / elapsed
+
+
+def main():
+    cl = load_cl()
+    charts = {'ch{}'.format(i): commodplot.seas_line_plot(cl[col]) for i, col in enumerate(cl.columns[-6:])}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        template = os.path.join(tmpdir, 'page.html')
+        with open(template, 'w') as fh:
+            fh.write('<title>{{ pagetitle }}</title>{% for k, v in data.items() %}{{ v }}{% endfor %}')
+
+        server = dashserver.DashboardServer(port=0)
+        server.register('/dash', lambda: dict(charts, name='dash'), template)
+        server.start()
+        url = server.url + '/dash'
+
+        start = time.perf_counter()
+        fetch(url)
+        print('first render                 {:8.1f}ms'.format((time.perf_counter() - start) * 1000))
+        with urllib.request.urlopen(url) as res:
+            etag = res.headers['ETag']
+
+        for viewers in [1, 8, 32]:
+            rps, bps = load_test(url, viewers, 200)
+            print('{:>3} viewers  200 responses  {:8.1f} req/s  {:8.1f} MB/s'.format(viewers, rps, bps / 1e6))
+            rps, _ = load_test(url, viewers, 200, etag=etag)
+            print('{:>3} viewers  304 responses  {:8.1f} req/s'.format(viewers, rps))
+
+        server.invalidate()
+        start = time.perf_counter()
+        fetch(url)
+        print('render after invalidate      {:8.1f}ms  (chart divs cached: {})'.format(
+            (time.perf_counter() - start) * 1000, server.fragment_cache.stats()))
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
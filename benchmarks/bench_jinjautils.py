@@ -0,0 +1,36 @@
+"""
+Benchmark html output of charts in jinjautils, comparing the default json number lists
+against binary encoded (base64 typed array) trace data, with and without float32 downcasting.
+
+Run from the repository root with: python -m benchmarks.bench_jinjautils
+"""
+import os
+import timeit
+
+import pandas as pd
+
+from benchmarks.bench_commodplot import daily_history, testdir
+from commodplot import commodplot
+from commodplot import jinjautils
+
+
+def load_cl_fwd():
+    return pd.read_csv(os.path.join(testdir, 'test_cl_fwd.csv'), index_col=0, parse_dates=True, dayfirst=True)
+
+
+def bench(name, fig, number=3):
+    base = None
+    for label, opts in [('default', {}), ('binary', dict(binary=True)), ('binary f32', dict(binary=True, float32=True))]:
+        t = min(timeit.repeat(lambda: jinjautils.plhtml(fig, **opts), number=number, repeat=3)) / number
+        size = len(jinjautils.plhtml(fig, **opts))
+        base = base or size
+        print('{:<30} {:<12} {:10,d} bytes ({:5.1%})  {:8.1f}ms'.format(name, label, size, size / base, t * 1000))
+
+
+def main():
+    bench('seas_line_plot (25yr daily)', commodplot.seas_line_plot(daily_history()))
+    bench('forward_history_plot', commodplot.forward_history_plot(load_cl_fwd()))
+
+
+if __name__ == '__main__':
+    main()
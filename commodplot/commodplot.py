@@ -9,33 +9,183 @@ from commodutil import transforms
 from plotly.subplots import make_subplots
 
 from commodplot import commodplottrace as cptr
+from commodplot import commodplottransform as cpt
 from commodplot import commodplotutil as cpu
 
 preset_margins = {'l': 0, 'r': 0, 't': 40, 'b': 0}
 
 
+def figure_from_traces(traces, fast=None, layout=None, subplots=None):
+    """
+    Assemble a figure from a list of traces.
+    In fast mode (see commodplottrace.fast_mode) the traces are plain dicts which are loaded
+    in one step without property validation, otherwise they are added to the figure one by one
+    :param traces:
+    :param fast:
+    :param layout: optional starting layout
+    :param subplots: optional figure from make_subplots, whose layout and subplot grid the figure takes
+    :return:
+    """
+    if cptr.is_fast_mode(fast):
+        return unvalidated_figure(traces, layout=layout, subplots=subplots)
+
+    if subplots is not None:
+        fig = go.Figure(subplots)
+    else:
+        fig = go.Figure(layout=layout)
+    for trace in traces:
+        fig.add_trace(trace)
+    return fig
+
+
+def unvalidated_figure(data, layout=None, subplots=None):
+    """
+    Build a figure whose trace data skips plotly's property validation, layout updates made afterwards
+    are validated as normal. A make_subplots figure passed as subplots keeps its grid, so row/col
+    arguments (add_trace, update_xaxes, get_subplot) still work on the result.
+    This relies on plotly internals (the _validate flags of BaseFigure and the _grid_str/_grid_ref
+    subplot grid) as of plotly 5.x, checked with plotly 5.24. Without them the data is validated as normal.
+    """
+    spec = {'data': data, 'layout': layout}
+    if subplots is not None:
+        spec.update(layout=subplots.layout, _grid_str=getattr(subplots, '_grid_str', None),
+                    _grid_ref=getattr(subplots, '_grid_ref', None))
+
+    fig = go.Figure(spec, _validate=False)
+    if not hasattr(fig, '_validate') or not hasattr(getattr(fig, '_layout_obj', None), '_validate'):
+        return go.Figure(spec)
+    fig._validate = True
+    fig._layout_obj._validate = True
+    return fig
+
+
+def subplot_axes(fig, row, col):
+    """
+    Return the axis references of a subplot cell, for traces which are not added via add_trace(row=, col=)
+    :param fig: figure from make_subplots
+    :param row:
+    :param col:
+    :return:
+    """
+    subplot = fig.get_subplot(row, col)
+    return dict(xaxis=subplot.xaxis.plotly_name.replace('axis', ''),
+                yaxis=subplot.yaxis.plotly_name.replace('axis', ''))
+
+
+def panel_kwargs(kwargs, **overrides):
+    """
+    Options for generating the traces of one subplot panel. When panels are generated in parallel
+    the traces are built as plain dicts (see commodplottrace.fast_mode) so they are cheap to send between processes.
+    Module level settings are resolved here as worker processes may not share them (eg with spawn)
+    :param kwargs: subplot kwargs
+    :param overrides: panel specific options, eg showlegend
+    :return:
+    """
+    res = {k: v for k, v in kwargs.items() if k not in ['executor', 'n_jobs']}
+    res['fast'] = cptr.is_fast_mode(kwargs.get('fast'))
+    if kwargs.get('executor') is not None or kwargs.get('n_jobs') not in [None, 1]:
+        res['fast'] = True
+    if res.get('webgl_threshold') is None:
+        res['webgl_threshold'] = False if cptr.webgl_threshold is None else cptr.webgl_threshold
+    res.update(overrides)
+    return res
+
+
+def seas_panel_traces(panel):
+    """
+    Generate the traces of one seas_line_subplot panel. Module level so it can run in a worker process
+    :param panel: tuple of (df, fwd, kwargs)
+    :return:
+    """
+    dfx, fwdx, kwargs = panel
+    return cptr.seas_plot_traces(dfx, fwd=fwdx, **kwargs)
+
+
+def reindex_panel_traces(panel):
+    """
+    Generate the traces of one reindex_year_line_subplot panel. Module level so it can run in a worker process
+    :param panel: tuple of (df, kwargs)
+    :return:
+    """
+    dfx, kwargs = panel
+    dft = cpt.reindex_year(dfx)
+    colsel = cpu.reindex_year_df_rel_col(dft)
+    return cptr.reindex_plot_traces(dft, current_select_year=colsel, **kwargs)
+
+
+def add_subplot_traces(fig, cells, results, trace_sets, fast=None):
+    """
+    Add the traces generated for each subplot panel to the figure, in panel order
+    :param fig: figure from make_subplots
+    :param cells: list of (row, col) of each panel
+    :param results: list of trace dicts of each panel, eg from seas_plot_traces
+    :param trace_sets: keys of the trace dicts to add, in order
+    :param fast:
+    :return: the figure, which is a new figure (with the same subplot grid) in fast mode
+    """
+    fast = cptr.is_fast_mode(fast)
+    data = []
+    for (row, col), traces in zip(cells, results):
+        for trace_set in trace_sets:
+            for trace in traces.get(trace_set, []):
+                if fast:
+                    trace.update(subplot_axes(fig, row, col))
+                    data.append(trace)
+                else:
+                    fig.add_trace(trace, row=row, col=col)
+
+    if fast:
+        fig = figure_from_traces(data, fast=fast, subplots=fig)
+    return fig
+
+
 def seas_line_plot(df, fwd=None, **kwargs):
     """
      Given a DataFrame produce a seasonal line plot (x-axis - Jan-Dec, y-axis Yearly lines)
      Can overlay a forward curve on top of this
     """
 
-    fig = go.Figure()
     traces = cptr.seas_plot_traces(df, fwd, **kwargs)
+    return seas_line_figure(traces, df, **kwargs)
+
+
+def seas_line_plot_batch(df, fwd=None, **kwargs):
+    """
+    Produce a seasonal line plot for every column of a wide DataFrame, see seas_line_plot.
+    Seasonalisation and shaded range statistics are calculated once for the whole frame.
+    Each chart is titled with its column name
+    :param df: dataframe with one timeseries per column
+    :param fwd: optional dataframe of forward curves, matched to df by column name
+    :param kwargs: options as for seas_line_plot
+    :return: dict of column name to figure
+    """
+    kwargs = {k: v for k, v in kwargs.items() if k != 'title'}
+    traces = cptr.seas_plot_traces_batch(df, fwd, **kwargs)
+    return {col: seas_line_figure(traces[col], df[col], title=str(col), **kwargs) for col in df.columns}
+
+
+def seas_line_figure(traces, df, **kwargs):
+    """
+    Assemble a seasonal line plot from the traces of seas_plot_traces
+    :param traces:
+    :param df: timeseries used for the title change summary
+    :param kwargs:
+    :return:
+    """
+    data = []
     if 'shaded_range' in traces:
-        for trace in traces['shaded_range']:
-            fig.add_trace(trace)
+        data.extend(traces['shaded_range'])
 
     if 'average_line' in traces:
-        fig.add_trace(traces['average_line'])
+        data.append(traces['average_line'])
 
     if 'hist' in traces:
-        for trace in traces['hist']:
-            fig.add_trace(trace)
+        data.extend(traces['hist'])
 
     if 'fwd' in traces:
-        for trace in traces['fwd']:
-            fig.add_trace(trace)
+        data.extend(traces['fwd'])
+
+    fig = figure_from_traces(data, fast=kwargs.get('fast'))
 
     fig.layout.xaxis.tickvals = pd.date_range(start=str(dates.curyear), periods=12, freq='MS')
 
@@ -49,9 +199,44 @@ def seas_line_plot(df, fwd=None, **kwargs):
     return fig
 
 
+def seas_line_plot_update(fig, new, fwd=None, **kwargs):
+    """
+    Update a seasonal line plot with new observations (eg the latest daily settlement) without rebuilding it.
+    Only the affected year lines, the title change summary and (if fwd is passed) the forward lines are updated,
+    prior years are not re-seasonalised and the shaded range/average line are left as they are.
+    :param fig: figure from seas_line_plot, updated in place, or a traces dict from seas_plot_traces
+    :param new: series of new observations
+    :param fwd: optional updated forward curve
+    :param kwargs: same options as passed to seas_line_plot
+    :return: the updated figure
+    """
+    if isinstance(fig, dict):
+        traces, latest = cptr.update_seas_plot_traces(fig, new, fwd=fwd, **kwargs)
+        return seas_line_figure(traces, latest, **kwargs)
+
+    count = len(fig.data)
+    hist = [x for x in fig.data if cptr.is_seas_year_trace(x)]
+    traces, latest = cptr.update_seas_plot_traces({'hist': list(hist)}, new, fwd=fwd, **kwargs)
+    added = traces['hist'][len(hist):]
+    fig.add_traces(added + traces.get('fwd', []))
+
+    # keep the trace order of seas_line_plot: shaded range/average, year lines, then forward lines
+    others = [x for x in fig.data[:count] if not cptr.is_seas_year_trace(x) and not cptr.is_seas_fwd_trace(x)]
+    hist = hist + list(fig.data[count:count + len(added)])
+    if fwd is not None:
+        fwd_traces = list(fig.data[count + len(added):])
+    else:
+        fwd_traces = [x for x in fig.data[:count] if cptr.is_seas_fwd_trace(x)]
+    fig.data = others + hist + fwd_traces
+
+    fig.update_layout(title_text=cpu.gen_title(latest, **kwargs))
+    return fig
+
+
 def seas_line_subplot(rows, cols, df, fwd=None, **kwargs):
     """
     Generate a plot with multiple seasonal subplots.
+    Pass n_jobs (or a concurrent.futures executor) to generate the panels in parallel worker processes
     :param rows:
     :param cols:
     :param dfs:
@@ -66,6 +251,7 @@ def seas_line_subplot(rows, cols, df, fwd=None, **kwargs):
         subplot_titles=kwargs.get('subplot_titles', None)
     )
 
+    cells, panels = [], []
     chartcount = 0
     for row in range(1, rows + 1):
         for col in range(1, cols + 1):
@@ -81,15 +267,15 @@ def seas_line_subplot(rows, cols, df, fwd=None, **kwargs):
 
             showlegend = True if chartcount == 0 else False
 
-            traces = cptr.seas_plot_traces(dfx, fwd=fwdx, showlegend=showlegend, **kwargs)
-
-            for trace_set in ['shaded_range', 'hist', 'fwd']:
-                if trace_set in traces:
-                    for trace in traces[trace_set]:
-                        fig.add_trace(trace, row=row, col=col)
+            cells.append((row, col))
+            panels.append((dfx, fwdx, panel_kwargs(kwargs, showlegend=showlegend)))
 
             chartcount += 1
 
+    results = cpu.parallel_map(seas_panel_traces, panels, executor=kwargs.get('executor'),
+                               n_jobs=kwargs.get('n_jobs'))
+    fig = add_subplot_traces(fig, cells, results, ['shaded_range', 'hist', 'fwd'], fast=kwargs.get('fast'))
+
     legend = go.layout.Legend(font=dict(size=10))
     fig.update_xaxes(tickvals=pd.date_range(start=str(dates.curyear), periods=12, freq='MS'), tickformat='%b')
     title = kwargs.get('title', '')
@@ -183,6 +369,7 @@ def table_plot(df, **kwargs):
 def forward_history_plot(df, title=None, **kwargs):
     """
      Given a dataframe of a curve's pricing history, plot a line chart showing how it has evolved over time
+     Pass max_points to downsample long curves (LTTB, see commodplottransform.downsample)
     """
     df = df.rename(columns={x: pd.to_datetime(x) for x in df.columns})
     df = df[sorted(list(df.columns), reverse=True)]  # have latest column first
@@ -190,18 +377,22 @@ def forward_history_plot(df, title=None, **kwargs):
         columns={x: cpu.format_date_col(x, '%d-%b-%y') for x in df.columns})  # make nice labels for legend eg 05-Dec
 
     colseq = py.colors.sequential.Aggrnyl
-    text = df.index.strftime('%b-%y')
+    hovertemplate = cptr.date_hovertemplate('%b-%y')
+    fast = kwargs.get('fast')
+    max_points = kwargs.get('max_points')
 
-    fig = go.Figure()
+    traces = []
     colcount = 0
     for col in df.columns:
         color = colseq[colcount] if colcount < len(colseq) else colseq[-1]
-        fig.add_trace(
-            go.Scatter(x=df.index, y=df[col], hoverinfo='y', name=str(col), line=dict(color=color),
-                       hovertemplate=cptr.hovertemplate_default, text=text))
+        ser = cpt.downsample(df[col], max_points)
+        traces.append(
+            cptr.make_trace(fast=fast, x=ser.index, y=ser, hoverinfo='y', name=str(col), line=dict(color=color),
+                            hovertemplate=hovertemplate))
 
         colcount = colcount + 1
 
+    fig = figure_from_traces(traces, fast=fast)
     fig['data'][0]['line']['width'] = 2.2  # make latest line thicker
     legend = go.layout.Legend(font=dict(size=10))
     yaxis_title = kwargs.get('yaxis_title', None)
@@ -246,12 +437,19 @@ def diff_plot(df, **kwargs):
     barcols = [x for x in df.columns if '-' in x]
     linecols = [x for x in df.columns if '-' not in x]
 
+    fast = cptr.is_fast_mode(kwargs.get('fast'))
     fig = make_subplots(rows=2, cols=1, row_heights=[0.8, 0.2], shared_xaxes=True, vertical_spacing=0.02)
-    for col in linecols:
-        fig.add_trace(go.Scatter(x=df.index, y=df[col], name=col))
-
-    for col in barcols:
-        fig.add_trace(go.Bar(x=df.index, y=df[col], name=col), row=2, col=1)
+    if fast:
+        data = [cptr.make_trace(fast=fast, x=df.index, y=df[col], name=col) for col in linecols]
+        data.extend(cptr.make_trace('bar', fast=fast, x=df.index, y=df[col], name=col, **subplot_axes(fig, 2, 1))
+                    for col in barcols)
+        fig = figure_from_traces(data, fast=fast, subplots=fig)
+    else:
+        for col in linecols:
+            fig.add_trace(go.Scatter(x=df.index, y=df[col], name=col))
+
+        for col in barcols:
+            fig.add_trace(go.Bar(x=df.index, y=df[col], name=col), row=2, col=1)
 
     title = kwargs.get('title', '')
     fig.update_layout(title_text=title, title_x=0.01, margin=preset_margins)
@@ -264,19 +462,18 @@ def reindex_year_line_plot(df, **kwargs):
     :param df:
     :return:
     """
-    fig = go.Figure()
-    dft = transforms.reindex_year(df)
+    dft = cpt.reindex_year(df)
     colsel = cpu.reindex_year_df_rel_col(dft)
 
     traces = cptr.reindex_plot_traces(dft, current_select_year=colsel, **kwargs)
-
+    data = []
     if 'shaded_range' in traces:
-        for trace in traces['shaded_range']:
-            fig.add_trace(trace)
+        data.extend(traces['shaded_range'])
 
     if 'hist' in traces:
-        for trace in traces['hist']:
-            fig.add_trace(trace)
+        data.extend(traces['hist'])
+
+    fig = figure_from_traces(data, fast=kwargs.get('fast'))
 
     kwargs['title_postfix'] = colsel
     title = cpu.gen_title(df[colsel], title_prefix=colsel, **kwargs)
@@ -304,21 +501,20 @@ def candle_chart(df, **kwargs):
 
 
 def stacked_area_chart(df, **kwargs):
-    fig = go.Figure()
     group = kwargs.get('stackgroup', 'stackgroup')
+    fast = kwargs.get('fast')
 
-    for col in df.columns:
-        fig.add_trace(go.Scatter(x=df.index, y=df[col], name=col, stackgroup=group))
+    traces = [cptr.make_trace(fast=fast, x=df.index, y=df[col], name=col, stackgroup=group) for col in df.columns]
+    fig = figure_from_traces(traces, fast=fast)
 
     fig.update_layout(title=kwargs.get('title', ''))
     return fig
 
 
 def bar_chart(df, **kwargs):
-    fig = go.Figure()
-
-    for col in df.columns:
-        fig.add_trace(go.Bar(x=df.index, y=df[col], name=col))
+    fast = kwargs.get('fast')
+    traces = [cptr.make_trace('bar', fast=fast, x=df.index, y=df[col], name=col) for col in df.columns]
+    fig = figure_from_traces(traces, fast=fast)
 
     hovermode = kwargs.get('hovermode', 'x')
     fig.update_layout(title=kwargs.get('title', ''), hovermode=hovermode)
@@ -338,6 +534,7 @@ def reindex_year_line_subplot(rows, cols, dfs, **kwargs):
         shared_xaxes=False,
     )
 
+    cells, panels = [], []
     chartcount = 0
     for row in range(1, rows + 1):
         for col in range(1, cols + 1):
@@ -347,17 +544,15 @@ def reindex_year_line_subplot(rows, cols, dfs, **kwargs):
                 continue
             showlegend = True if chartcount == 0 else False
 
-            dfx = dfs[chartcount]
-            dft = transforms.reindex_year(dfx)
-            colsel = cpu.reindex_year_df_rel_col(dft)
-            traces = cptr.reindex_plot_traces(dft, current_select_year=colsel, showlegend=showlegend, **kwargs)
-            for trace_set in ['shaded_range', 'hist']:
-                if trace_set in traces:
-                    for trace in traces[trace_set]:
-                        fig.add_trace(trace, row=row, col=col)
+            cells.append((row, col))
+            panels.append((dfs[chartcount], panel_kwargs(kwargs, showlegend=showlegend)))
 
             chartcount += 1
 
+    results = cpu.parallel_map(reindex_panel_traces, panels, executor=kwargs.get('executor'),
+                               n_jobs=kwargs.get('n_jobs'))
+    fig = add_subplot_traces(fig, cells, results, ['shaded_range', 'hist'], fast=kwargs.get('fast'))
+
     legend = go.layout.Legend(font=dict(size=10))
     yaxis_title = kwargs.get('yaxis_title', None)
     hovermode = kwargs.get('hovermode', 'closest')
@@ -371,10 +566,8 @@ def reindex_year_line_subplot(rows, cols, dfs, **kwargs):
 
 
 def line_plot(df, fwd=None, **kwargs):
-    fig = go.Figure()
     res = cptr.line_plot_traces(df, fwd, **kwargs)
-    for trace in res:
-        fig.add_trace(trace)
+    fig = figure_from_traces(res, fast=kwargs.get('fast'))
 
     title = cpu.gen_title(df, inc_change_sum=False, **kwargs)
     legend = go.layout.Legend(font=dict(size=10))
@@ -1,3 +1,6 @@
+import uuid
+
+import numpy as np
 import pandas as pd
 
 table_style = [
@@ -39,7 +42,15 @@ def color_accounting(val):
     color = 'red' if val < 0 else 'green'
     return 'color: %s' % color
 
-def generate_table(df: pd.DataFrame, precision:int=None, accounting_col_columns: list = None):
+def generate_table(df: pd.DataFrame, precision:int=None, accounting_col_columns: list = None, fast: bool = False):
+    """
+    Render a dataframe as a styled html table (see table_style), colouring accounting_col_columns red/green
+    :param fast: build the html directly with vectorised colouring rather than through pandas Styler,
+                 much quicker for large tables. Tables with a MultiIndex always use Styler
+    """
+    if fast and df.index.nlevels == 1 and df.columns.nlevels == 1:
+        return generate_table_fast(df, precision=precision, accounting_col_columns=accounting_col_columns)
+
     if accounting_col_columns:
         res = (df.style.applymap(color_accounting, subset=accounting_col_columns).set_table_styles(table_style))
     else:
@@ -48,3 +59,53 @@ def generate_table(df: pd.DataFrame, precision:int=None, accounting_col_columns:
     if precision:
         res = res.format(precision=2)
     return res.to_html()
+
+
+def generate_table_fast(df: pd.DataFrame, precision: int = None, accounting_col_columns: list = None):
+    """
+    Html table equivalent to the Styler based generate_table: same css and number formatting, but red/green
+    is set through a class per cell computed for whole columns at once, and the html is joined directly
+    """
+    tid = 'T_{}'.format(uuid.uuid4().hex[:5])
+    # as the Styler path, any precision formats floats to 2dp, otherwise Styler's default precision
+    digits = 2 if precision else pd.get_option('styler.format.precision')
+    accounting_col_columns = accounting_col_columns or []
+
+    css = ['#{} {} {{\n{}}}'.format(tid, x['selector'], ''.join('  {}: {};\n'.format(k, v) for k, v in x['props']))
+           for x in table_style]
+    css.append('#{} td.neg {{\n  color: red;\n}}\n#{} td.pos {{\n  color: green;\n}}'.format(tid, tid))
+
+    header = ['<th class="blank level0" >&nbsp;</th>']
+    header += ['<th class="col_heading level0 col{}" >{}</th>'.format(j, col) for j, col in enumerate(df.columns)]
+    header = ['<tr>' + ''.join(header) + '</tr>']
+    if df.index.name is not None:
+        blank = ''.join('<th class="blank col{}" >&nbsp;</th>'.format(j) for j in range(len(df.columns)))
+        header.append('<tr><th class="index_name level0" >{}</th>{}</tr>'.format(df.index.name, blank))
+
+    rows = np.arange(len(df)).astype(str)
+    cells = [np.char.add(np.char.add('<tr><th class="row_heading level0 row', rows), '" >').astype(object)
+             + np.array([str(x) for x in df.index], dtype=object) + '</th>']
+    for j, col in enumerate(df.columns):
+        values = df.iloc[:, j]
+        classes = ''
+        if col in accounting_col_columns:
+            # nan is not negative, so shows green as color_accounting
+            classes = np.where(values.values < 0, ' neg', ' pos').astype(object)
+        prefix = np.char.add(np.char.add('<td class="data row', rows), ' col{}'.format(j)).astype(object)
+        cells.append(prefix + classes + '" >' + format_column(values, digits) + '</td>')
+
+    body = ''.join(np.sum(cells, axis=0) + '</tr>\n') if len(df) else ''
+    return ('<style type="text/css">\n{}\n</style>\n<table id="{}">\n<thead>\n{}\n</thead>\n<tbody>\n{}</tbody>\n'
+            '</table>\n').format('\n'.join(css), tid, '\n'.join(header), body)
+
+
+def format_column(values: pd.Series, digits: int):
+    """
+    Format a column for display as Styler does: floats to digits decimal places, anything else as str
+    """
+    if values.dtype.kind == 'f':
+        return np.char.mod('%.{}f'.format(digits), values.values).astype(object)
+    if values.dtype.kind in 'iub':
+        return values.values.astype(str).astype(object)
+    return np.array(['{:.{}f}'.format(x, digits) if isinstance(x, float) else str(x) for x in values],
+                    dtype=object)
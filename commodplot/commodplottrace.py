@@ -1,4 +1,5 @@
-import numpy as np
+import warnings
+
 import numpy as np
 import pandas as pd
 import plotly
@@ -10,7 +11,91 @@ from commodplot import commodplottransform as cpt
 from commodplot import commodplotutil as cpu
 from commodplot.commodplotutil import default_line_col, year_col_map
 
+
+def date_hovertemplate(date_format='%d-%b-%y'):
+    """
+    Hovertemplate showing the y value and the x date, formatted in the browser (d3 time format)
+    rather than shipping a text array of formatted dates with every trace
+    :param date_format: eg '%d-%b'
+    :return:
+    """
+    return '%{y:.2f}: <i>%{x|' + date_format + '}</i>'
+
+
+# hovertemplate for traces carrying a text array of formatted dates
 hovertemplate_default = '%{y:.2f}: <i>%{text}</i>'
+date_hovertemplate_default = date_hovertemplate()
+
+
+def hover_props(text=None, hover_date_format='%d-%b'):
+    """
+    Hover properties of a trace: the date formatted in the browser, or where a text array of
+    formatted dates is given (as in previous versions) the text with hovertemplate_default
+    :return: dict of hovertemplate and text
+    """
+    if text is not None:
+        return dict(hovertemplate=hovertemplate_default, text=text)
+    return dict(hovertemplate=date_hovertemplate(hover_date_format), text=None)
+
+# when enabled, trace builders return plain trace dicts rather than validated graph objects
+# so that figures can be assembled in one step (see commodplot.figure_from_traces)
+fast_mode = False
+
+# line traces with more points than this are rendered with WebGL (Scattergl) rather than SVG, None to disable
+webgl_threshold = 20000
+
+trace_types = {
+    'scatter': go.Scatter,
+    'scattergl': go.Scattergl,
+    'bar': go.Bar,
+}
+
+
+def is_fast_mode(fast=None):
+    """
+    Determine if traces should be emitted as plain dicts. A per-call setting overrides the module setting
+    :param fast:
+    :return:
+    """
+    return fast_mode if fast is None else fast
+
+
+def scatter_type(npoints, threshold=None):
+    """
+    Choose between SVG and WebGL scatter traces based on the number of points.
+    A per-call threshold overrides the module level webgl_threshold, pass False to always use SVG
+    :param npoints: number of points in the trace (or set of traces)
+    :param threshold:
+    :return: 'scattergl' or 'scatter'
+    """
+    if threshold is None:
+        threshold = webgl_threshold
+    if threshold is None or threshold is False:
+        return 'scatter'
+    return 'scattergl' if npoints > threshold else 'scatter'
+
+
+def make_trace(trace_type='scatter', fast=None, **props):
+    """
+    Build a trace of the given plotly type. In fast mode return a plain dict which skips
+    plotly's property validation, otherwise return the graph object
+    :param trace_type: plotly trace type, eg 'scatter' or 'bar'
+    :param fast: override module level fast_mode
+    :param props: trace properties
+    :return:
+    """
+    if is_fast_mode(fast):
+        return dict(type=trace_type, **drop_none(props))
+    return trace_types[trace_type](**props)
+
+
+def drop_none(props):
+    """
+    Remove unset (None) properties, including those of nested dicts, as plotly does when validating
+    :param props:
+    :return:
+    """
+    return {k: drop_none(v) if isinstance(v, dict) else v for k, v in props.items() if v is not None}
 
 
 def get_year_line_col(year):
@@ -76,11 +161,14 @@ def clean_seas_df_for_min_max_average(seas, range):
     seasf = seas.rename(columns=dates.find_year(seas))
 
     # only consider when we have full(er) data for a given range
-    fulldata = pd.DataFrame(seasf.isna().sum())  # count non-na values
-    if not (fulldata == 0).all().iloc[0]:  # line below doesn't apply when we have full data for all columns
-        fulldata = fulldata[fulldata.apply(lambda x: np.abs(x - x.mean()) / x.std() < 1.5).all(
-            axis=1)]  # filter columns with high emtply values
-    seasf = seasf[fulldata.index]  # use these column names only
+    nacount = seasf.isna().to_numpy().sum(axis=0)  # count na values per column
+    if nacount.any():  # filter below doesn't apply when we have full data for all columns
+        if len(nacount) < 2:
+            seasf = seasf.iloc[:, :0]  # a single column has no z-score (nan), so is filtered as before
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                zscore = np.abs(nacount - nacount.mean()) / nacount.std(ddof=1)
+            seasf = seasf.loc[:, zscore < 1.5]  # filter columns with high emtply values
 
     if isinstance(range, int):
         end_year = dates.curyear - 1
@@ -92,6 +180,75 @@ def clean_seas_df_for_min_max_average(seas, range):
     return r
 
 
+def band_stats(seas, year_range, percentiles=None):
+    """
+    Calculate the min, max, mean and optionally percentiles across years for every day of a
+    seasonalised dataframe, in one pass over the underlying numpy array
+    :param seas:
+    :param year_range: int for number of years before the current year, or (start_year, end_year)
+    :param percentiles: list of percentiles, eg [10, 90] adds columns p10 and p90
+    :return: dataframe of band statistics and the number of years in the range (None if less than 2)
+    """
+    r = clean_seas_df_for_min_max_average(seas, year_range)
+    values = r.to_numpy(dtype=float)
+    percentiles = list(percentiles) if percentiles else []
+
+    if values.shape[1] == 0:
+        stats = np.full((len(r), 3 + len(percentiles)), np.nan)
+    else:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)  # days with no data give nan
+            stats = [np.nanmin(values, axis=1), np.nanmax(values, axis=1), np.nanmean(values, axis=1)]
+            if percentiles:
+                stats.extend(np.nanpercentile(values, percentiles, axis=1))
+        stats = np.column_stack(stats)
+
+    columns = ['min', 'max', 'mean'] + ['p%s' % x for x in percentiles]
+    res = pd.DataFrame(stats, index=r.index, columns=columns)
+
+    rangeyr = int(values.shape[1]) if values.shape[1] >= 2 else None
+    return res, rangeyr
+
+
+def band_stats_batch(seas, year_range, percentiles=None):
+    """
+    Band statistics (as band_stats) for many seasonalised dataframes sharing the same index, eg from
+    seasonalise_wide. The years of all frames are stacked into one 3-D array and reduced in a single pass.
+    :param seas: dict of name to seasonalised dataframe
+    :param year_range:
+    :param percentiles:
+    :return: dict of name to (band statistics dataframe, number of years in range)
+    """
+    cleaned = {k: clean_seas_df_for_min_max_average(v, year_range) for k, v in seas.items()}
+    if len(cleaned) == 0:
+        return {}
+
+    index = next(iter(cleaned.values())).index
+    if any(not x.index.equals(index) for x in cleaned.values()):
+        return {k: band_stats(v, year_range, percentiles) for k, v in seas.items()}
+
+    years = sorted(set(y for x in cleaned.values() for y in x.columns))
+    percentiles = list(percentiles) if percentiles else []
+    columns = ['min', 'max', 'mean'] + ['p%s' % x for x in percentiles]
+    if len(years) == 0:
+        values = np.full((len(index), len(cleaned), 1), np.nan)
+    else:
+        # days x frames x years
+        values = np.stack([x.reindex(columns=years).to_numpy(dtype=float) for x in cleaned.values()], axis=1)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)  # days with no data give nan
+        stats = [np.nanmin(values, axis=2), np.nanmax(values, axis=2), np.nanmean(values, axis=2)]
+        if percentiles:
+            stats.extend(np.nanpercentile(values, percentiles, axis=2))
+
+    res = {}
+    for i, (k, r) in enumerate(cleaned.items()):
+        df = pd.DataFrame(np.column_stack([x[:, i] for x in stats]), index=index, columns=columns)
+        res[k] = (df, int(len(r.columns)) if len(r.columns) >= 2 else None)
+    return res
+
+
 def min_max_mean_range(seas, shaded_range):
     """
     Calculate min and max for seas
@@ -101,39 +258,31 @@ def min_max_mean_range(seas, shaded_range):
     :param shaded_range:
     :return:
     """
-    r = clean_seas_df_for_min_max_average(seas, shaded_range)
-
-    res = r.copy()
-    res['min'] = res.min(1)
-    res['max'] = res.max(1)
-    res['mean'] = res.mean(1)
-    res = res[['min', 'max', 'mean']]
-
-    if len(r.columns) >= 2:
-        rangeyr = int(len(r.columns))  # end_year - start_year
-    else:
-        rangeyr = None
-    return res, rangeyr
+    return band_stats(seas, shaded_range)
 
 
-def shaded_range_traces(seas, shaded_range, showlegend=True):
+def shaded_range_traces(seas, shaded_range, showlegend=True, fast=None, percentiles=None, bands=None):
     """
     Given a dataframe, calculate the min/max for every day of the year
     and return this as a trace for the min/max shaded area
     :param seas:
     :param shaded_range:
     :param showlegend:
+    :param fast: emit plain trace dicts
+    :param percentiles: optional (low, high) percentiles, eg (10, 90), to add an inner shaded band
+    :param bands: precomputed result of band_stats(seas, shaded_range, percentiles)
     :return:
     """
-    r, rangeyr = min_max_mean_range(seas, shaded_range)
+    r, rangeyr = bands if bands is not None else band_stats(seas, shaded_range, percentiles)
     if isinstance(shaded_range, int):
         name = '%syr' % rangeyr
     else:
         name = '%s-%s' % (str(shaded_range[0])[-2:], str(shaded_range[1])[-2:])
 
+    traces = []
     if rangeyr is not None:
-        traces = []
-        max_trace = go.Scatter(x=r.index,
+        max_trace = make_trace(fast=fast,
+                               x=r.index,
                                y=r['max'].values,
                                fill=None,
                                name='%s Max' % name,
@@ -143,7 +292,8 @@ def shaded_range_traces(seas, shaded_range, showlegend=True):
                                showlegend=showlegend,
                                legendgroup='min')
         traces.append(max_trace)
-        min_trace = go.Scatter(x=r.index,
+        min_trace = make_trace(fast=fast,
+                               x=r.index,
                                y=r['min'].values,
                                fill='tonexty',
                                name='%s Min' % name,
@@ -153,19 +303,47 @@ def shaded_range_traces(seas, shaded_range, showlegend=True):
                                showlegend=showlegend,
                                legendgroup='max')
         traces.append(min_trace)
+
+        if percentiles:
+            low, high = percentiles
+            high_trace = make_trace(fast=fast,
+                                    x=r.index,
+                                    y=r['p%s' % high].values,
+                                    fill=None,
+                                    name='%s P%s' % (name, high),
+                                    mode='lines',
+                                    line_color='lightslategray',
+                                    line_width=0.1,
+                                    showlegend=showlegend,
+                                    legendgroup='phigh')
+            traces.append(high_trace)
+            low_trace = make_trace(fast=fast,
+                                   x=r.index,
+                                   y=r['p%s' % low].values,
+                                   fill='tonexty',
+                                   name='%s P%s' % (name, low),
+                                   mode='lines',
+                                   line_color='lightslategray',
+                                   line_width=0.1,
+                                   showlegend=showlegend,
+                                   legendgroup='plow')
+            traces.append(low_trace)
     return traces
 
 
-def average_line_trace(seas, average_line):
+def average_line_trace(seas, average_line, fast=None, bands=None):
     """
     Given a dataframe, calculate the mean for every day of the year
     and return this as a trace for the average line
     :param seas:
     :param average_line:
+    :param fast: emit plain trace dicts
+    :param bands: precomputed result of band_stats(seas, average_line)
     :return:
     """
-    r, rangeyr = min_max_mean_range(seas, average_line)
-    trace = go.Scatter(x=r.index,
+    r, rangeyr = bands if bands is not None else band_stats(seas, average_line)
+    trace = make_trace(fast=fast,
+                       x=r.index,
                        y=r['mean'].values,
                        fill=None,
                        name='%syr Avg' % rangeyr,
@@ -178,23 +356,30 @@ def average_line_trace(seas, average_line):
     return trace
 
 
-def timeseries_to_seas_trace(seas, text, dash=None, showlegend=True, visible_line_years=None):
+def timeseries_to_seas_trace(seas, text=None, dash=None, showlegend=True, visible_line_years=None,
+                             fast=None, webgl_threshold=None, hover_date_format='%d-%b'):
     """
     Given a dataframe of reindexed data, generate traces for every year
     :param seas:
-    :param text:
+    :param text: optional formatted dates for the hover labels, by default dates are formatted in the browser
     :param dash:
     :param showlegend:
+    :param fast: emit plain trace dicts
+    :param webgl_threshold: total points above which the year lines use Scattergl
+    :param hover_date_format: date format of the x value in hover labels
     :return:
     """
     traces = []
+    trace_type = scatter_type(seas.size, webgl_threshold)
+    hover = hover_props(text, hover_date_format)
     for col in seas.columns:
-        trace = go.Scatter(x=seas.index,
+        trace = make_trace(trace_type,
+                           fast=fast,
+                           x=seas.index,
                            y=seas[col],
                            hoverinfo='y',
                            name=str(col),
-                           hovertemplate=hovertemplate_default,
-                           text=text,
+                           **hover,
                            visible=line_visible(col, visible_line_years),
                            line=dict(color=get_year_line_col(col),
                                      dash=dash,
@@ -206,9 +391,12 @@ def timeseries_to_seas_trace(seas, text, dash=None, showlegend=True, visible_lin
     return traces
 
 
-def timeseries_to_reindex_year_trace(dft, text, dash=None, current_select_year=None, showlegend=True):
+def timeseries_to_reindex_year_trace(dft, text=None, dash=None, current_select_year=None,
+                                     showlegend=True, fast=None, webgl_threshold=None, hover_date_format='%d-%b'):
     traces = []
     colyearmap = cpu.dates.find_year(dft)
+    trace_type = scatter_type(dft.size, webgl_threshold)
+    hover = hover_props(text, hover_date_format)
 
     for col in dft.columns:
         colyear = colyearmap[col]
@@ -218,12 +406,13 @@ def timeseries_to_reindex_year_trace(dft, text, dash=None, current_select_year=N
                 current_select_year = colyearmap[current_select_year]
             if colyear >= current_select_year:
                 width = 2.2
-        trace = go.Scatter(x=dft.index,
+        trace = make_trace(trace_type,
+                           fast=fast,
+                           x=dft.index,
                            y=dft[col],
                            hoverinfo='y',
                            name=str(col),
-                           hovertemplate=hovertemplate_default,
-                           text=text,
+                           **hover,
                            visible=line_visible(colyear),
                            line=dict(color=get_year_line_col(colyear),
                                      dash=dash,
@@ -244,45 +433,233 @@ def seas_plot_traces(df, fwd=None, **kwargs):
     :param kwargs:
     :return:
     """
-    res = {}
     histfreq = kwargs.get('histfreq', None)
     if histfreq is None:
         histfreq = cpu.infer_freq(df)
     seas = cpt.seasonalise(df, histfreq=histfreq)
 
-    text = seas.index.strftime('%b')
+    shaded_percentiles = kwargs.get('shaded_percentiles', None)
+    bands = {str(x): band_stats(seas, x, percentiles=shaded_percentiles) for x in seas_band_ranges(**kwargs)}
+
+    return seas_traces(seas, df.index[-1], fwd=fwd, bands=bands, **dict(kwargs, histfreq=histfreq))
+
+
+def seas_plot_traces_batch(df, fwd=None, **kwargs):
+    """
+    Generate seasonal plot traces for every column of a wide dataframe.
+    Frequency inference and seasonalisation are done once for the whole frame
+    and the band statistics once for all columns together.
+    :param df: dataframe with one timeseries per column
+    :param fwd: optional dataframe of forward curves, matched to df by column name
+    :param kwargs: options as for seas_plot_traces
+    :return: dict of column name to traces
+    """
+    histfreq = kwargs.get('histfreq', None)
+    if histfreq is None:
+        histfreq = cpu.infer_freq(df)
+    seas = cpt.seasonalise_wide(df, histfreq=histfreq)
+
+    shaded_percentiles = kwargs.get('shaded_percentiles', None)
+    bands = {str(x): band_stats_batch(seas, x, percentiles=shaded_percentiles) for x in seas_band_ranges(**kwargs)}
+
+    res = {}
+    for col in df.columns:
+        fwdx = fwd[col] if fwd is not None and col in fwd.columns else None
+        colbands = {k: v[col] for k, v in bands.items()}
+        res[col] = seas_traces(seas[col], df[col].index[-1], fwd=fwdx, bands=colbands,
+                               **dict(kwargs, histfreq=histfreq))
+    return res
+
+
+def seas_band_ranges(**kwargs):
+    """
+    Year ranges which need band statistics, each is calculated once and shared by the shaded range and average line
+    """
+    res = []
+    for year_range in [kwargs.get('shaded_range', None), kwargs.get('average_line', None)]:
+        if year_range is not None and year_range not in res:
+            res.append(year_range)
+    return res
+
+
+def seas_traces(seas, last_date, fwd=None, bands=None, **kwargs):
+    """
+    Generate the seasonal plot traces from an already seasonalised dataframe
+    :param seas: seasonalised dataframe
+    :param last_date: last date of the historical data
+    :param fwd:
+    :param bands: dict of band_stats results keyed by str(year range), see seas_band_ranges
+    :param kwargs: options as for seas_plot_traces, histfreq is the frequency of the historical data
+    :return:
+    """
+    res = {}
+    histfreq = kwargs.get('histfreq', None)
+    hover_date_format = '%b'
     if histfreq in ['B', 'D', 'W']:
-        text = seas.index.strftime('%d-%b')
+        hover_date_format = '%d-%b'
 
     showlegend = kwargs.get('showlegend', None)
     visible_line_years = kwargs.get('visible_line_years', None)
+    fast = kwargs.get('fast', None)
+    bands = bands or {}
 
     # shaded range
     shaded_range = kwargs.get('shaded_range', None)
+    shaded_percentiles = kwargs.get('shaded_percentiles', None)
     if shaded_range is not None:
-        res['shaded_range'] = shaded_range_traces(seas, shaded_range, showlegend=showlegend)
+        res['shaded_range'] = shaded_range_traces(seas, shaded_range, showlegend=showlegend, fast=fast,
+                                                  percentiles=shaded_percentiles, bands=bands.get(str(shaded_range)))
 
     # average line
     average_line = kwargs.get('average_line', None)
     if average_line is not None:
-        res['average_line'] = average_line_trace(seas, average_line)
+        res['average_line'] = average_line_trace(seas, average_line, fast=fast, bands=bands.get(str(average_line)))
 
     # historical / solid lines
-    res['hist'] = timeseries_to_seas_trace(seas, text, showlegend=showlegend, visible_line_years=visible_line_years)
+    res['hist'] = timeseries_to_seas_trace(seas, showlegend=showlegend, visible_line_years=visible_line_years,
+                                           fast=fast, webgl_threshold=kwargs.get('webgl_threshold'),
+                                           hover_date_format=hover_date_format)
 
     # fwd / dotted lines
     if fwd is not None:
-        fwdfreq = pd.infer_freq(fwd.index)
-        # for charts which are daily, resample the forward curve into a daily series
-        if histfreq in ['B', 'D'] and fwdfreq in ['MS', 'ME']:
-            fwd = transforms.format_fwd(fwd, df.index[-1])  # only applies for forward curves
-        fwdseas = cpt.seasonalise(fwd, histfreq=fwdfreq)
-
-        res['fwd'] = timeseries_to_seas_trace(fwdseas, text, showlegend=showlegend, dash='dot')
+        res['fwd'] = seas_fwd_traces(fwd, last_date, hover_date_format, **kwargs)
 
     return res
 
 
+def seas_fwd_traces(fwd, last_date, hover_date_format='%d-%b', **kwargs):
+    """
+    Generate the dotted forward curve year lines of a seasonal plot
+    :param fwd: forward curve
+    :param last_date: last date of the historical data
+    :param hover_date_format:
+    :param kwargs: histfreq is the frequency of the historical data
+    :return:
+    """
+    histfreq = kwargs.get('histfreq', None)
+    fwdfreq = pd.infer_freq(fwd.index)
+    # for charts which are daily, resample the forward curve into a daily series
+    if histfreq in ['B', 'D'] and fwdfreq in ['MS', 'ME']:
+        fwd = transforms.format_fwd(fwd, last_date)  # only applies for forward curves
+    fwdseas = cpt.seasonalise(fwd, histfreq=fwdfreq)
+
+    return timeseries_to_seas_trace(fwdseas, showlegend=kwargs.get('showlegend', None), dash='dot',
+                                    fast=kwargs.get('fast', None), webgl_threshold=kwargs.get('webgl_threshold'),
+                                    hover_date_format=hover_date_format)
+
+
+def is_seas_fwd_trace(trace):
+    """
+    Forward year lines of a seasonal plot are dotted, works with graph objects and plain trace dicts
+    """
+    line = trace.get('line', {}) if isinstance(trace, dict) else trace.line
+    dash = line.get('dash') if isinstance(line, dict) else line.dash
+    return dash == 'dot'
+
+
+def is_seas_year_trace(trace):
+    """
+    Historical year lines of a seasonal plot are named by their year
+    """
+    return str(trace['name']).isnumeric() and not is_seas_fwd_trace(trace)
+
+
+def update_seas_hist_traces(hist, new, **kwargs):
+    """
+    Merge new observations into the year lines of a seasonal plot, in place.
+    Only the years present in the new observations are touched, other years are not re-seasonalised.
+    Gaps between the previous last value and the new values are filled forward, as seasonalise does.
+    :param hist: year line traces, eg seas_plot_traces()['hist']
+    :param new: series of new observations (actual dates, daily or monthly)
+    :param kwargs: same options as passed to seas_plot_traces
+    :return: list of traces created for years not yet in hist, series of the latest two observations
+    """
+    if isinstance(new, pd.DataFrame):
+        new = new[new.columns[0]]
+    new = new.dropna()
+    new = new[~((new.index.month == 2) & (new.index.day == 29))]  # seasonalise removes leap dates
+
+    traces = {int(t['name']): t for t in hist}
+    seas_index = pd.DatetimeIndex(hist[0]['x']) if hist else pd.DatetimeIndex([])
+    added = []
+    for year, obs in new.groupby(new.index.year):
+        obs.index = pd.DatetimeIndex([pd.Timestamp(dates.curyear, x.month, x.day) for x in obs.index])
+
+        if year in traces:
+            trace = traces[year]
+            y = pd.Series(np.asarray(trace['y'], dtype=float), index=pd.DatetimeIndex(trace['x']))
+        else:
+            y = pd.Series(np.nan, index=seas_index)
+        y = obs.combine_first(y)
+        last = y.last_valid_index()
+        y.loc[:last] = y.loc[:last].ffill()
+
+        if year in traces:
+            trace['x'] = y.index
+            trace['y'] = y.values
+        else:
+            trace = timeseries_to_seas_trace(pd.DataFrame({year: y}), showlegend=kwargs.get('showlegend', None),
+                                             visible_line_years=kwargs.get('visible_line_years', None),
+                                             fast=kwargs.get('fast', None))[0]
+            if hist and '%{text}' not in hist[0]['hovertemplate']:
+                trace['hovertemplate'] = hist[0]['hovertemplate']
+            traces[year] = trace
+            added.append(trace)
+
+    return added, latest_seas_observations(traces)
+
+
+def latest_seas_observations(traces):
+    """
+    Given year line traces keyed by year, return the latest two observations (for the title change summary)
+    """
+    res = []
+    for year in sorted(traces, reverse=True):
+        y = pd.Series(np.asarray(traces[year]['y'], dtype=float)).dropna()
+        res = list(y.iloc[-(2 - len(res)):]) + res
+        if len(res) >= 2:
+            break
+    return pd.Series(res, dtype=float)
+
+
+def seas_hist_freq(hist, new):
+    """
+    Infer the frequency of the historical data of a seasonal plot from the year line x values,
+    falling back to the new observations and then daily (as cpu.infer_freq)
+    :param hist: year line traces
+    :param new: series of new observations
+    :return:
+    """
+    indexes = [pd.DatetimeIndex(x['x']) for x in hist] + [new.index]
+    for index in sorted(indexes, key=len, reverse=True):
+        if len(index) >= 3:
+            freq = pd.infer_freq(index)
+            if freq is not None:
+                return freq
+    return 'D'
+
+
+def update_seas_plot_traces(traces, new, fwd=None, **kwargs):
+    """
+    Incrementally update the traces from seas_plot_traces with new observations, in place.
+    The shaded range and average line are left as they are. If fwd is passed the forward lines are regenerated.
+    :param traces: dict from seas_plot_traces
+    :param new: series of new observations
+    :param fwd: optional updated forward curve
+    :param kwargs: same options as passed to seas_plot_traces
+    :return: the updated traces dict and series of the latest two observations
+    """
+    added, latest = update_seas_hist_traces(traces['hist'], new, **kwargs)
+    traces['hist'].extend(added)
+
+    if fwd is not None:
+        histfreq = kwargs.get('histfreq', None) or seas_hist_freq(traces['hist'], new)
+        hover_date_format = '%d-%b' if histfreq in ['B', 'D', 'W'] else '%b'
+        traces['fwd'] = seas_fwd_traces(fwd, new.index[-1], hover_date_format, **dict(kwargs, histfreq=histfreq))
+
+    return traces, latest
+
+
 def reindex_plot_traces(df, **kwargs):
     """
     Generate traces for a timeseries that is being turned into a reindex year plot.
@@ -294,16 +671,17 @@ def reindex_plot_traces(df, **kwargs):
     res = {}
     showlegend = kwargs.get('showlegend', None)
     current_select_year = kwargs.get('current_select_year', None)
-
-    text = df.index.strftime('%d-%b')
+    fast = kwargs.get('fast', None)
 
     shaded_range = kwargs.get('shaded_range', None)
     if shaded_range is not None:
-        res['shaded_range'] = shaded_range_traces(df, shaded_range, showlegend=showlegend)
+        res['shaded_range'] = shaded_range_traces(df, shaded_range, showlegend=showlegend, fast=fast,
+                                                  percentiles=kwargs.get('shaded_percentiles', None))
 
     # historical / solid lines
-    res['hist'] = timeseries_to_reindex_year_trace(df, text, current_select_year=current_select_year,
-                                                   showlegend=showlegend)
+    res['hist'] = timeseries_to_reindex_year_trace(df, current_select_year=current_select_year,
+                                                   showlegend=showlegend, fast=fast,
+                                                   webgl_threshold=kwargs.get('webgl_threshold'))
 
     return res
 
@@ -312,10 +690,12 @@ def timeseries_trace(series: pd.Series, **kwargs) -> go.Scatter:
     """
     Return a standard timeseries trace for use in a plotly figure
     :param series: Pandas timeseries of data
-    :param kwargs: kwargs for various formatting options
+    :param kwargs: kwargs for various formatting options, max_points to downsample long series,
+                   webgl_threshold for the number of points above which to use Scattergl
     :return:
     """
     series = series.dropna()
+    series = cpt.downsample(series, kwargs.get('max_points'))
 
     # name
     name = series.name
@@ -324,14 +704,18 @@ def timeseries_trace(series: pd.Series, **kwargs) -> go.Scatter:
 
     # hover text formatting
     hover_date_format = kwargs.get('hover_date_format', '%d-%b-%y')
+    hovertemplate = kwargs.get('hovertemplate', date_hovertemplate(hover_date_format))
+    text = series.index.strftime(hover_date_format) if '%{text}' in hovertemplate else None
 
-    t = go.Scatter(
+    t = make_trace(
+        scatter_type(len(series), kwargs.get('webgl_threshold')),
+        fast=kwargs.get('fast'),
         x=series.index,
         y=series.values,
         hoverinfo='y',
         name=name,
-        hovertemplate=kwargs.get('hovertemplate', hovertemplate_default),
-        text=series.index.strftime(hover_date_format),
+        hovertemplate=hovertemplate,
+        text=text,
         visible=kwargs.get('visible'),
         line=dict(
             width=kwargs.get('width'),
@@ -370,7 +754,10 @@ def timeseries_trace_by_year(series: pd.Series, colyear: int, promptyear: int =
                          visible=visible,
                          color=color,
                          legendgroup=kwargs.get('legendgroup'),
-                         showlegend=kwargs.get('showlegend'))
+                         showlegend=kwargs.get('showlegend'),
+                         max_points=kwargs.get('max_points'),
+                         webgl_threshold=kwargs.get('webgl_threshold'),
+                         fast=kwargs.get('fast'))
     return t
 
 
@@ -383,14 +770,16 @@ def line_plot_traces(df, fwd=None, **kwargs):
     :return:
     """
     traces = []
+    # options passed through to each trace
+    opts = {x: kwargs.get(x) for x in ['max_points', 'webgl_threshold', 'fast']}
     colyearmap = cpu.dates.find_year(df)
     colcount = 0
     for col in df.columns:
         colyear = colyearmap[col]
         if isinstance(colyear, int) or (isinstance(colyear, str) and colyear.isnumeric()):
-            trace = timeseries_trace_by_year(df[col], colyear, legendgroup=col)  # , text, **kwargs)
+            trace = timeseries_trace_by_year(df[col], colyear, legendgroup=col, **opts)  # , text, **kwargs)
         else:
-            trace = timeseries_trace(df[col], legendgroup=col, color=get_sequence_line_col(colcount))  #
+            trace = timeseries_trace(df[col], legendgroup=col, color=get_sequence_line_col(colcount), **opts)  #
 
         traces.append(trace)
 
@@ -400,10 +789,10 @@ def line_plot_traces(df, fwd=None, **kwargs):
             if fwdfreq in ['MS', 'ME']:
                 f = transforms.format_fwd(f, df.index[-1])  # only applies for forward curves
             if isinstance(colyear, int) or (isinstance(colyear, str) and colyear.isnumeric()):
-                trace = timeseries_trace_by_year(f, colyear, legendgroup=col, showlegend=False, )  # , text, **kwargs)
+                trace = timeseries_trace_by_year(f, colyear, legendgroup=col, showlegend=False, **opts)
             else:
                 trace = timeseries_trace(f, dash='dash', legendgroup=col, showlegend=False,
-                                         color=get_sequence_line_col(colcount))
+                                         color=get_sequence_line_col(colcount), **opts)
             traces.append(trace)
 
         colcount = colcount + 1
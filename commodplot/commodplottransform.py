@@ -1,13 +1,116 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
 import pandas as pd
+from commodutil import dates
 from commodutil import transforms
 
 
+class TransformCache:
+    """
+    LRU cache of transform results (eg seasonalised or reindexed dataframes), keyed on a fingerprint
+    of the input data. Bounded by the total size in bytes of the cached results.
+    """
+
+    def __init__(self, maxbytes: int = 256 * 1024 * 1024):
+        self.maxbytes = maxbytes
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.currbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return a copy of the cached result for key, or None if not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return entry[0].copy()
+
+    def put(self, key, value):
+        nbytes = int(value.memory_usage(index=True, deep=True).sum())
+        if nbytes > self.maxbytes:
+            return  # too large to cache at all
+        with self._lock:
+            if key in self._entries:
+                self.currbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value.copy(), nbytes)
+            self.currbytes += nbytes
+            while self.currbytes > self.maxbytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.currbytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.currbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'currbytes': self.currbytes,
+            'maxbytes': self.maxbytes,
+        }
+
+
+transform_cache = TransformCache()
+
+
+def fingerprint(df, *args):
+    """
+    Cheap content hash of a dataframe/series (index, values and column names) plus any extra arguments
+    :param df:
+    :param args: additional parameters affecting the transform, eg frequency
+    :return:
+    """
+    if isinstance(df, pd.Series):
+        df = pd.DataFrame(df)
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    h.update(repr((list(df.columns), [str(x) for x in df.dtypes], args)).encode())
+    return h.hexdigest()
+
+
+def cached_transform(name, func, df, *args):
+    """
+    Apply func(df, *args), using the transform cache when enabled
+    """
+    if not transform_cache.enabled:
+        return func(df, *args)
+
+    key = (name, fingerprint(df, *args))
+    res = transform_cache.get(key)
+    if res is None:
+        res = func(df, *args)
+        transform_cache.put(key, res)
+    return res
+
+
 def seasonalise(df, histfreq):
     """
     Given a dataframe, seasonalise the data, returning seasonalised dataframe
+    Results are cached on the content of the input (see transform_cache)
     :param df:
     :return:
     """
+    return cached_transform('seasonalise', _seasonalise, df, histfreq)
+
+
+def _seasonalise(df, histfreq):
     if isinstance(df, pd.Series):
         df = pd.DataFrame(df)
 
@@ -23,3 +126,111 @@ def seasonalise(df, histfreq):
 
     seas = seas.dropna(how='all', axis=1)  # dont plot empty years
     return seas
+
+
+def seasonalise_wide(df, histfreq=None):
+    """
+    Seasonalise every column of a wide dataframe in one pass, rather than column by column
+    :param df: dataframe with one timeseries per column
+    :param histfreq:
+    :return: dict of column name to seasonalised dataframe, as returned by seasonalise
+    """
+    if histfreq is None:
+        histfreq = pd.infer_freq(df.index)
+        if histfreq is None:
+            histfreq = 'D'  # sometimes infer_freq returns null - assume mostly will be a daily series
+
+    if histfreq.startswith('W'):
+        return {col: seasonalise(df[col], histfreq) for col in df.columns}
+
+    s = df[~((df.index.month == 2) & (df.index.day == 29))]  # remove leap dates 29 Feb
+    seas = s.groupby([s.index.month, s.index.day, s.index.year]).mean().unstack()  # columns of (column, year)
+    seas.index = pd.DatetimeIndex([pd.Timestamp(dates.curyear, m, d) for m, d in seas.index])
+    seas = fill_between(seas)
+
+    res = {}
+    for col in df.columns:
+        x = seas[col].dropna(how='all', axis=1)  # dont plot empty years
+        x.columns.name = None
+        res[col] = x
+    return res
+
+
+def fill_between(df):
+    """
+    Fill gaps (weekends/holidays) in each column, but not before the first or after the last value
+    """
+    return df.ffill().where(df.bfill().notna())
+
+
+def reindex_year(df):
+    """
+    Reindex a dataframe of yearly contracts to the current year, see commodutil.transforms.reindex_year
+    Results are cached on the content of the input (see transform_cache)
+    :param df:
+    :return:
+    """
+    return cached_transform('reindex_year', transforms.reindex_year, df)
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling: select n_out points which preserve the visual shape of a line.
+    The first and last points are always kept. Triangle areas are computed with numpy per bucket.
+    :param x: numeric x values (ascending)
+    :param y: y values
+    :param n_out: number of points to return, with fewer than 3 only the last (and first) point are kept
+    :return: array of selected positions
+    """
+    n = len(x)
+    if n_out < 1:
+        raise ValueError('n_out must be at least 1, got {}'.format(n_out))
+    if n_out >= n:
+        return np.arange(n)
+    if n_out < 3:
+        return np.array([0, n - 1][-n_out:], dtype=int)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    # bucket boundaries for the points between the first and last
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    # average point of each bucket, used as the third triangle vertex for the previous bucket
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1) / counts
+    avg_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1) / counts
+    avg_x = np.append(avg_x, x[-1])
+    avg_y = np.append(avg_y, y[-1])
+
+    res = np.empty(n_out, dtype=int)
+    res[0] = 0
+    res[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        cx, cy = avg_x[i + 1], avg_y[i + 1]
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        res[i + 1] = a
+
+    return res
+
+
+def downsample(series, max_points=None):
+    """
+    Reduce a timeseries to at most max_points using LTTB, keeping the first and last observations exact
+    (the last only when max_points is 1)
+    :param series:
+    :param max_points: if None or series is already small enough, return series unchanged
+    :return:
+    """
+    if max_points is None or len(series) <= max_points:
+        return series
+
+    series = series.dropna()
+    if len(series) <= max_points:
+        return series
+
+    index = series.index
+    x = index.asi8 if isinstance(index, pd.DatetimeIndex) else np.arange(len(series))
+    return series.iloc[lttb_indices(x, series.values, max_points)]
@@ -1,3 +1,5 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import pandas as pd
 from commodutil import dates
 from commodutil import transforms
@@ -173,3 +175,26 @@ def std_yr_col(df, asdict=False):
 
     # return array of colours to use - this can be passed into cufflift iplot method
     return [colmap[x] for x in df]
+
+
+def parallel_map(func, items, executor=None, n_jobs=None, threads=False):
+    """
+    Apply func to each item, returning results in the order of items.
+    :param func: for process pools func must be defined at module level
+    :param items:
+    :param executor: concurrent.futures executor to use
+    :param n_jobs: number of workers to start when no executor is given, -1 for one per cpu. None or 1 runs serially
+    :param threads: use a thread pool rather than a process pool when starting workers
+    :return:
+    """
+    items = list(items)
+    if executor is not None:
+        return list(executor.map(func, items))
+
+    if n_jobs in [None, 1] or len(items) <= 1:
+        return [func(x) for x in items]
+
+    workers = None if n_jobs == -1 else n_jobs
+    pool = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    with pool(max_workers=workers) as ex:
+        return list(ex.map(func, items))
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+import plotly as pl
+from plotly import graph_objects as go
+
+from commodplot import commodplotutil as cpu
+from commodplot import jinjautils
+
+
+class DashboardBuilder:
+    """
+    Incremental build of many dashboards with jinjautils.
+    Each page's inputs (data, template source and globals) are hashed and pages whose inputs are unchanged
+    since the last build are skipped. Rendered pages are only written when the output differs from the file on disk.
+    Hashes are kept in a json manifest between runs. Note templates showing last_gen_time will differ
+    whenever a page is rendered, so for those only skipping unchanged inputs avoids a write.
+    Callables in the data are called on every build and hashed on their result. Output settings
+    (eg jinjautils.lazy_charts and the plotly version) are part of the hash, see output_settings.
+    """
+
+    def __init__(self, manifest=None, stable_ids=True, compress=None):
+        """
+        :param manifest: location of the json file recording the input hash of each page, None to keep in memory only
+        :param stable_ids: number chart div ids by position on the page (rather than random ids) so unchanged
+                           pages render identically
+        :param compress: also write precompressed pages, see jinjautils.PageWriter
+        """
+        self.manifest = manifest
+        self.stable_ids = stable_ids
+        self.compress = compress
+        self.pages = []
+        self.hashes = {}
+        self._lock = threading.Lock()
+        if manifest and os.path.exists(manifest):
+            with open(manifest, encoding='utf8') as fh:
+                self.hashes = json.load(fh)
+
+    def add(self, data, template, filename, package_loader_name=None, template_globals=None, **kwargs):
+        """
+        Add a page to build, arguments as for jinjautils.render_html
+        """
+        self.pages.append(dict(data=data, template=template, filename=filename,
+                               package_loader_name=package_loader_name, template_globals=template_globals,
+                               kwargs=kwargs))
+
+    def build(self, force=False, n_jobs=None):
+        """
+        Build all pages added
+        :param force: render all pages even if their inputs are unchanged
+        :param n_jobs: number of pages to render concurrently (in threads), None renders one at a time
+        :return: list of dicts of filename, status (skipped, unchanged or written) and seconds taken
+        """
+        results = cpu.parallel_map(lambda page: self.build_page(page, force=force), self.pages, n_jobs=n_jobs,
+                                   threads=True)
+        self.save_manifest()
+        logging.info(build_report(results))
+        return results
+
+    def build_page(self, page, force=False):
+        start = time.perf_counter()
+        filename = page['filename']
+        tdirname, tfilename = os.path.split(os.path.abspath(page['template']))
+        renderer = jinjautils.get_renderer(template_dir=tdirname, package_loader_name=page['package_loader_name'])
+
+        # rendering replaces figures in the data, so render a copy leaving the page as added for the next build
+        data = copy_dicts(page['data'])
+        for parent, k, path in jinjautils.find_dict_thunks(data):
+            parent[k] = jinjautils.evaluate_thunk(parent[k])
+
+        h = hashlib.sha256()
+        update_hash(h, jinjautils.template_sources(renderer.env, tfilename))
+        update_hash(h, [data, page['template_globals'], page['kwargs'], self.output_settings(page)])
+        key = h.hexdigest()
+
+        if not force and self.hashes.get(filename) == key and os.path.exists(filename):
+            status = 'skipped'
+        else:
+            for parent, k, fig in jinjautils.find_dict_plotly_figs(data):
+                parent[k] = go.Figure(fig)  # plhtml sets the margins of the figure it converts
+            output = renderer.render(data, tfilename, template_globals=page['template_globals'], **page['kwargs'])
+            if self.stable_ids:
+                output = number_div_ids(output)
+            status = 'written' if write_if_different(filename, output, compress=self.compress) else 'unchanged'
+            with self._lock:
+                self.hashes[filename] = key
+
+        return {'filename': filename, 'status': status, 'seconds': time.perf_counter() - start}
+
+    def output_settings(self, page):
+        """
+        Settings besides the page inputs which change the rendered output, resolved as for the render
+        """
+        lazy = page['kwargs'].get('lazy')
+        return {
+            'lazy': jinjautils.lazy_charts if lazy is None else lazy,
+            'binary': jinjautils.binary_arrays,
+            'float32': jinjautils.binary_float32,
+            'plotly': pl.__version__,
+            'stable_ids': self.stable_ids,
+            'compress': jinjautils.compress_formats(self.compress),
+        }
+
+    def save_manifest(self):
+        if not self.manifest:
+            return
+        tmp = '{}.{}.tmp'.format(self.manifest, uuid.uuid4().hex)
+        with open(tmp, 'w', encoding='utf8') as fh:
+            json.dump(self.hashes, fh, indent=1, sort_keys=True)
+        os.replace(tmp, self.manifest)
+
+
+def build_report(results):
+    """
+    Summary of a build, one line per page with the time taken
+    """
+    lines = ['{:<10} {:8.3f}s  {}'.format(x['status'], x['seconds'], x['filename']) for x in results]
+    counts = {s: len([x for x in results if x['status'] == s]) for s in ['written', 'unchanged', 'skipped']}
+    lines.append('{written} written, {unchanged} unchanged, {skipped} skipped'.format(**counts))
+    return '\n'.join(lines)
+
+
+def update_hash(h, value):
+    """
+    Update hash h with the content of value, recursing into dicts and lists.
+    Figures and pandas objects are hashed on their content
+    """
+    if isinstance(value, dict):
+        h.update(b'd')
+        for k in sorted(value, key=str):
+            update_hash(h, str(k))
+            update_hash(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update(b'l%d' % len(value))
+        for x in value:
+            update_hash(h, x)
+    elif isinstance(value, go.Figure):
+        h.update(value.to_json().encode('utf8'))
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        h.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+        h.update(repr(list(value.columns) if isinstance(value, pd.DataFrame) else value.name).encode())
+    elif isinstance(value, np.ndarray):
+        h.update(value.tobytes())
+    else:
+        h.update(repr(value).encode('utf8'))
+
+
+def copy_dicts(d):
+    """
+    Copy the (nested) dicts of a data dict, sharing the values, so rendering does not replace figures in the original
+    """
+    return {k: copy_dicts(v) if isinstance(v, dict) else v for k, v in d.items()}
+
+
+def number_div_ids(html):
+    """
+    Replace the random ids of plotly chart divs with ids numbered by position on the page
+    """
+    ids = re.findall(r'<div id="([0-9a-f\-]{36})" class="plotly-graph-div', html)
+    for i, divid in enumerate(ids):
+        html = html.replace(divid, 'chart-{}'.format(i))
+    return html
+
+
+def write_if_different(filename, output, compress=None):
+    """
+    Write output (and any precompressed copies) to filename unless the file already has the same content
+    :return: True if the file was written
+    """
+    siblings = ['{}.{}'.format(filename, x) for x in jinjautils.compress_formats(compress)]
+    if all(os.path.exists(x) for x in [filename] + siblings):
+        with open(filename, encoding='utf8') as fh:
+            if fh.read() == output:
+                return False
+
+    with jinjautils.PageWriter(filename, compress=compress) as writer:
+        writer.write(output)
+    return True
@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from commodplot import dashbuilder
+from commodplot import jinjautils
+
+
+class DashboardServer:
+    """
+    Small http server rendering registered dashboards on demand.
+    Rendered pages are cached in memory for ttl seconds (or until invalidated), chart divs are cached
+    on the figure content (see jinjautils.MemoryFragmentCache) and conditional requests are answered
+    with 304 Not Modified using ETags.
+
+    eg
+        server = DashboardServer(port=8050)
+        server.register('/crude', build_crude_data, 'templates/crude.html')
+        server.serve_forever()
+    """
+
+    def __init__(self, host='127.0.0.1', port=8050, ttl=300, fragment_cache_bytes: int = 256 * 1024 * 1024):
+        """
+        :param host:
+        :param port: 0 to pick a free port, see url
+        :param ttl: seconds a rendered page is served from cache, None to cache until invalidated
+        :param fragment_cache_bytes: size of the in-memory chart div cache
+        """
+        self.ttl = ttl
+        self.dashboards = {}
+        self.pages = {}  # path -> (body, etag, expires)
+        self.fragment_cache = jinjautils.MemoryFragmentCache(maxbytes=fragment_cache_bytes)
+        self._lock = threading.Lock()
+        self._render_locks = {}
+        self.httpd = ThreadingHTTPServer((host, port), DashboardRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.dashboards = self
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def register(self, path, data, template, package_loader_name=None, template_globals=None, **kwargs):
+        """
+        Register a dashboard at path, arguments as for jinjautils.render_html
+        :param data: dict of jinja parameters, or a callable returning one (called on each render)
+        """
+        with self._lock:
+            self.dashboards[path] = dict(data=data, template=template, package_loader_name=package_loader_name,
+                                         template_globals=template_globals, kwargs=kwargs)
+            self._render_locks[path] = threading.Lock()
+            self.pages.pop(path, None)
+
+    def invalidate(self, path=None):
+        """
+        Drop the cached page for path (or all pages) so it is rendered again on the next request
+        """
+        with self._lock:
+            if path is None:
+                self.pages.clear()
+            else:
+                self.pages.pop(path, None)
+
+    def page(self, path):
+        """
+        Return (body, etag) for path, rendering the dashboard if not cached. None if path is not registered
+        """
+        if path not in self.dashboards:
+            return None
+
+        page = self._cached(path)
+        if page is None:
+            with self._render_locks[path]:  # concurrent viewers wait for one render
+                page = self._cached(path)
+                if page is None:
+                    body = self.render(path).encode('utf8')
+                    expires = None if self.ttl is None else time.monotonic() + self.ttl
+                    page = (body, '"{}"'.format(hashlib.sha256(body).hexdigest()[:32]), expires)
+                    with self._lock:
+                        self.pages[path] = page
+
+        return page[0], page[1]
+
+    def _cached(self, path):
+        with self._lock:
+            page = self.pages.get(path)
+        if page is not None and (page[2] is None or page[2] > time.monotonic()):
+            return page
+        return None
+
+    def render(self, path):
+        dash = self.dashboards[path]
+        data = dash['data']() if callable(dash['data']) else dashbuilder.copy_dicts(dash['data'])
+        tdirname, tfilename = os.path.split(os.path.abspath(dash['template']))
+        renderer = jinjautils.get_renderer(template_dir=tdirname, package_loader_name=dash['package_loader_name'])
+
+        lazy = dash['kwargs'].get('lazy')
+        for parent, k, fig in jinjautils.find_dict_plotly_figs(data):
+            parent[k] = jinjautils.plhtml(fig, cache=self.fragment_cache, lazy=lazy)
+
+        logging.info('Rendering dash {} for {}'.format(data['name'], path))
+        output = renderer.render(data, tfilename, template_globals=dash['template_globals'], **dash['kwargs'])
+        return dashbuilder.number_div_ids(output)  # unchanged pages keep their etag when rendered again
+
+    def serve_forever(self):
+        logging.info('Serving dashboards on {}'.format(self.url))
+        self.httpd.serve_forever()
+
+    def start(self):
+        """
+        Serve in a background thread
+        """
+        thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class DashboardRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        try:
+            page = self.server.dashboards.page(path)
+        except Exception:
+            logging.exception('Failed to render {}'.format(path))
+            self.send_error(500)
+            return
+
+        if page is None:
+            self.send_error(404)
+            return
+
+        body, etag = page
+        if etag in [x.strip() for x in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')  # browsers revalidate with If-None-Match
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.address_string(), format % args)
+
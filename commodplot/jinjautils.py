@@ -1,53 +1,575 @@
+import asyncio
 import base64
+import gzip
+import hashlib
+import inspect
+import json
 import logging
 import os
-from datetime import datetime
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime
+from functools import partial
 
+import numpy as np
+import pandas as pd
 import plotly as pl
-from jinja2 import PackageLoader, FileSystemLoader, Environment
+from jinja2 import PackageLoader, FileSystemLoader, Environment, FileSystemBytecodeCache, Undefined, meta, nodes
 from plotly import graph_objects as go
 
+from commodplot import commodplotutil as cpu
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 # margin to use in HTML charts - make charts bigger but leave space for title
 narrow_margin = {'l': 2, 'r': 2, 't': 30, 'b': 10}
 
 
-def render_html(data, template, filename, package_loader_name=None, template_globals=None):
+def render_html(data, template, filename, package_loader_name=None, template_globals=None, n_jobs=None,
+                stream=False, lazy=None, thunk_jobs=None, compress=None):
     """
     Using a Jinja2 template, render a html file and save to disk
+    Templates are compiled once and reused across calls, see HtmlRenderer
     :param data: dict of jinja parameters to include in rendered html
     :param template: absolute location of template file
     :param filename: location of where rendered html file should be output
     :param package_loader_name: if using PackageLoader instead of FileLoader specify package name
+    :param n_jobs: number of worker processes used to convert figures to html, see convert_dict_plotly_fig_html_div
+    :param stream: convert figures as the template reaches them and write the page in chunks, see HtmlRenderer.stream_html
+    :param lazy: only plot charts in the browser when they are scrolled into view, see lazy_charts
+    :param thunk_jobs: values in data may be callables (or awaitables) returning figures, which are evaluated
+                       only if the template outputs them. Pass thunk_jobs to evaluate them concurrently in threads
+    :param compress: also write precompressed filename.gz/.br, eg ['gz', 'br'] or True, see PageWriter
     :return:
     """
-    data = convert_dict_plotly_fig_html_div(data)
-
     tdirname, tfilename = os.path.split(os.path.abspath(template))
-    if package_loader_name:
-        loader = PackageLoader(package_loader_name, 'templates')
-    else:
-        loader = FileSystemLoader(tdirname)
-    env = Environment(loader=loader)
-    env.finalize = jinja_finalize
-    template = env.get_template(tfilename)
-    if template_globals:
-        for template_global in template_globals:
-            template.globals[template_global] = template_globals[template_global]
-
-    logging.info('Writing dash {} to {}'.format(data['name'], filename))
-
-    output = template.render(pagetitle=data['name'], last_gen_time=datetime.now(), data=data)
-    with open(filename, "w", encoding='utf8') as fh:
-        fh.write(output)
+    renderer = get_renderer(template_dir=tdirname, package_loader_name=package_loader_name)
+    if stream:
+        return renderer.stream_html(data, tfilename, filename, template_globals=template_globals, lazy=lazy,
+                                    thunk_jobs=thunk_jobs, compress=compress)
+    return renderer.render_html(data, tfilename, filename, template_globals=template_globals, n_jobs=n_jobs,
+                                lazy=lazy, thunk_jobs=thunk_jobs, compress=compress)
+
+
+class HtmlRenderer:
+    """
+    Reusable Jinja2 renderer. Owns one Environment so templates are loaded and compiled once
+    (and optionally kept in an on-disk bytecode cache between runs). Safe to share across threads.
+    """
+
+    def __init__(self, template_dir=None, package_loader_name=None, bytecode_cache_dir=None,
+                 template_globals=None):
+        """
+        :param template_dir: directory of templates when using a FileSystemLoader
+        :param package_loader_name: if using PackageLoader instead of FileLoader specify package name
+        :param bytecode_cache_dir: directory for compiled template bytecode, shared between runs
+        :param template_globals: dict of globals available to all templates
+        """
+        if package_loader_name:
+            loader = PackageLoader(package_loader_name, 'templates')
+        else:
+            loader = FileSystemLoader(template_dir)
+
+        bytecode_cache = None
+        if bytecode_cache_dir:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+
+        self.env = Environment(loader=loader, bytecode_cache=bytecode_cache, finalize=jinja_finalize)
+        if template_globals:
+            self.env.globals.update(template_globals)
+
+    def render(self, data, template, template_globals=None, n_jobs=None, lazy=None, thunk_jobs=None):
+        """
+        Render a template to a string
+        :param data: dict of jinja parameters, plotly figures are converted to html divs
+        :param template: template name
+        :param template_globals: dict of globals for this render only
+        :param n_jobs: number of worker processes used to convert figures to html
+        :param lazy: emit charts as deferred payloads plotted when scrolled into view, see lazy_charts
+        :param thunk_jobs: number of threads evaluating callables in data concurrently, see prefetch_thunks
+        :return:
+        """
+        lazy = lazy_charts if lazy is None else lazy
+        data = convert_dict_plotly_fig_html_div(data, n_jobs=n_jobs, lazy=lazy)
+        if thunk_jobs:
+            self.prefetch_thunks(data, template, thunk_jobs, lazy=lazy)
+        slot_thunks(data, lazy=lazy)
+        return self.env.get_template(template).render(self.context(data, template_globals, lazy))
+
+    def prefetch_thunks(self, data, template, thunk_jobs, lazy=None):
+        """
+        Start evaluating the callables/awaitables in data which the template (or templates it extends/includes)
+        refers to, eg {{ data.sub.ch1 }}, in a pool of threads. Each is replaced in data by a Deferred result.
+        Thunks only reached dynamically (eg by looping over data) are still evaluated when output.
+        """
+        referenced = referenced_data_paths(self.env, template)
+        thunks = [(parent, k) for parent, k, path in find_dict_thunks(data) if path in referenced]
+        if not thunks:
+            return
+        ex = ThreadPoolExecutor(max_workers=None if thunk_jobs == -1 else thunk_jobs)
+        for parent, k in thunks:
+            parent[k] = Deferred(ex.submit(evaluate_thunk_html, parent[k], lazy))
+        ex.shutdown(wait=False)  # queued thunks still run
+
+    @staticmethod
+    def context(data, template_globals=None, lazy=False):
+        # per-render globals are passed in the context rather than set on the (shared) template
+        context = dict(template_globals or {})
+        context.update(pagetitle=data['name'], last_gen_time=datetime.now(), data=data)
+        if lazy:
+            # templates include lazy_charts_script (after the charts) when lazy_charts is set, see base.html
+            context.update(lazy_charts=True, lazy_charts_script=lazy_charts_script)
+        return context
+
+    def render_html(self, data, template, filename, template_globals=None, n_jobs=None, lazy=None, thunk_jobs=None,
+                    compress=None):
+        """
+        Render a template and save to disk, see render_html
+        :return: filename
+        """
+        output = self.render(data, template, template_globals=template_globals, n_jobs=n_jobs, lazy=lazy,
+                             thunk_jobs=thunk_jobs)
+        logging.info('Writing dash {} to {}'.format(data['name'], filename))
+        return write_page(filename, output, compress=compress)
+
+    def generate(self, data, template, template_globals=None, lazy=None, thunk_jobs=None):
+        """
+        Render a template as a generator of html chunks. Figures in data are converted to divs only
+        when the template reaches them and are released once serialised, so at most one figure's html is held in memory
+        :param data: dict of jinja parameters, plotly figures are replaced in place (see FigureSlot)
+        :param template: template name
+        :param template_globals: dict of globals for this render only
+        :param lazy: emit charts as deferred payloads plotted when scrolled into view, see lazy_charts
+        :return:
+        """
+        lazy = lazy_charts if lazy is None else lazy
+        for parent, k, fig in find_dict_plotly_figs(data):
+            parent[k] = FigureSlot(fig, lazy=lazy)
+        if thunk_jobs:
+            self.prefetch_thunks(data, template, thunk_jobs, lazy=lazy)
+        slot_thunks(data, lazy=lazy)
+        return self.env.get_template(template).generate(self.context(data, template_globals, lazy))
+
+    def stream_html(self, data, template, filename, template_globals=None, lazy=None, thunk_jobs=None,
+                    compress=None):
+        """
+        Render a template to disk chunk by chunk, see generate. Output is written to a temp file
+        alongside filename and moved into place once complete, so readers never see a partial page
+        :return: filename
+        """
+        logging.info('Streaming dash {} to {}'.format(data['name'], filename))
+        with PageWriter(filename, compress=compress) as fh:
+            for chunk in self.generate(data, template, template_globals=template_globals, lazy=lazy,
+                                       thunk_jobs=thunk_jobs):
+                fh.write(chunk)
+
+        return filename
 
+
+def write_page(filename, output, compress=None):
+    """
+    Write a rendered page (and any precompressed copies, see PageWriter) to disk
+    :return: filename
+    """
+    write_page_temp(filename, output, compress=compress).commit()
     return filename
 
 
+def write_page_temp(filename, output, compress=None):
+    """
+    Write a rendered page to temp files alongside filename, without moving them into place
+    :return: the PageWriter, to commit (or discard)
+    """
+    writer = PageWriter(filename, compress=compress)
+    try:
+        writer.write(output)
+        writer.finish()
+    except BaseException:
+        writer.close(commit=False)
+        raise
+    return writer
+
+
+class AsyncRenderer:
+    """
+    Asyncio counterparts of render_html, plhtml and plpng for use inside an event loop (eg a web service).
+    Figure serialisation, templating, image export and file writes run in an executor, so the loop is not blocked.
+    At most max_concurrency calls run at once. Cancelling a call cancels its queued executor work
+    and nothing is written to disk: pages are written to temp files which are only moved into place
+    once the write completes uncancelled.
+    """
+
+    def __init__(self, max_concurrency: int = 4, executor=None):
+        """
+        :param max_concurrency: number of renders/conversions allowed to run at the same time
+        :param executor: concurrent.futures executor for blocking work, None for the loop's default (threads)
+        """
+        self.max_concurrency = max_concurrency
+        self.executor = executor
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:  # created on first use, inside the running loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run a blocking function in the executor
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def plhtml(self, fig, **kwargs):
+        async with self.semaphore:
+            return await self.run(plhtml, fig, **kwargs)
+
+    async def plpng(self, fig, exporter=None):
+        async with self.semaphore:
+            return await self.run(plpng, fig, exporter=exporter)
+
+    async def render(self, data, template, package_loader_name=None, template_globals=None, lazy=None):
+        """
+        Render a template to a string, see render_html. Awaitables in data referred to by the template
+        are awaited in the loop, figures are converted concurrently in the executor
+        :return: html
+        """
+        async with self.semaphore:
+            tdirname, tfilename = os.path.split(os.path.abspath(template))
+            renderer = get_renderer(template_dir=tdirname, package_loader_name=package_loader_name)
+            lazy = lazy_charts if lazy is None else lazy
+
+            referenced = referenced_data_paths(renderer.env, tfilename)
+            awaitables = [(parent, k) for parent, k, path in find_dict_thunks(data)
+                          if path in referenced and inspect.isawaitable(parent[k])]
+            values = await asyncio.gather(*[parent[k] for parent, k in awaitables])
+            for (parent, k), value in zip(awaitables, values):
+                parent[k] = value
+
+            figs = find_dict_plotly_figs(data)
+            divs = await asyncio.gather(*[self.run(plhtml, fig, lazy=lazy) for parent, k, fig in figs])
+            for (parent, k, fig), div in zip(figs, divs):
+                parent[k] = div
+
+            slot_thunks(data, lazy=lazy)
+            context = renderer.context(data, template_globals, lazy)
+            return await self.run(renderer.env.get_template(tfilename).render, context)
+
+    async def render_html(self, data, template, filename, package_loader_name=None, template_globals=None,
+                          lazy=None, compress=None):
+        """
+        Render a template and save to disk, see render_html
+        :return: filename
+        """
+        output = await self.render(data, template, package_loader_name=package_loader_name,
+                                   template_globals=template_globals, lazy=lazy)
+        logging.info('Writing dash {} to {}'.format(data['name'], filename))
+        async with self.semaphore:
+            # a write in progress can't be interrupted, so on cancellation its temp files are removed once done
+            write = asyncio.ensure_future(self.run(write_page_temp, filename, output, compress=compress))
+            try:
+                writer = await asyncio.shield(write)
+            except asyncio.CancelledError:
+                write.add_done_callback(discard_page_temp)
+                raise
+            writer.commit()
+            return filename
+
+
+def discard_page_temp(write):
+    """
+    Done callback removing the temp files of a cancelled write_page_temp
+    """
+    if not write.cancelled() and write.exception() is None:
+        write.result().discard()
+
+
+class PageWriter:
+    """
+    Write a html page, plus precompressed copies (filename.gz, filename.br) for static file servers.
+    Each chunk written is compressed as it arrives, so no second copy of the page is held in memory.
+    Files are written to temp files and moved into place together on close, or removed on error.
+    """
+
+    closed = False
+
+    def __init__(self, filename, compress=None):
+        """
+        :param filename:
+        :param compress: list of formats to write alongside filename, 'gz' and/or 'br' (requires brotli).
+                         True for gz, plus br when brotli is installed
+        """
+        compress = compress_formats(compress)
+        token = uuid.uuid4().hex
+        self.files = []  # (tmp, target, file, compressor)
+        self.files.append(self._open(filename, token, None))
+        for fmt in compress:
+            self.files.append(self._open('{}.{}'.format(filename, fmt), token, fmt))
+
+    @staticmethod
+    def _open(target, token, fmt):
+        tmp = '{}.{}.tmp'.format(target, token)
+        fh = open(tmp, 'wb')
+        if fmt == 'gz':
+            return tmp, target, gzip.GzipFile(filename='', mode='wb', fileobj=fh, mtime=0), fh
+        if fmt == 'br':
+            return tmp, target, BrotliFile(fh), fh
+        return tmp, target, fh, fh
+
+    def write(self, chunk):
+        data = chunk.encode('utf8')
+        for tmp, target, writer, fh in self.files:
+            writer.write(data)
+
+    def finish(self):
+        """
+        Complete the temp files, see commit and discard
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for tmp, target, writer, fh in self.files:
+            if writer is not fh:
+                writer.close()  # flush the compressed stream
+            fh.close()
+
+    def commit(self):
+        """
+        Move the temp files into place
+        """
+        self.finish()
+        for tmp, target, writer, fh in self.files:
+            os.replace(tmp, target)
+
+    def discard(self):
+        """
+        Remove the temp files
+        """
+        self.finish()
+        for tmp, target, writer, fh in self.files:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def close(self, commit=True):
+        if commit:
+            self.commit()
+        else:
+            self.discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.close(commit=exc_type is None)
+
+
+def compress_formats(compress):
+    """
+    Normalise the compress option of PageWriter to a list of formats
+    """
+    if compress is True:
+        compress = ['gz', 'br'] if brotli is not None else ['gz']
+    compress = [compress] if isinstance(compress, str) else list(compress or [])
+    if 'br' in compress and brotli is None:
+        raise ImportError('brotli is required for .br output, pip install brotli')
+    return compress
+
+
+class BrotliFile:
+    """
+    Minimal writable file which brotli compresses into an underlying file
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.compressor = brotli.Compressor(mode=brotli.MODE_TEXT)
+
+    def write(self, data):
+        self.fh.write(self.compressor.process(data))
+
+    def close(self):
+        self.fh.write(self.compressor.finish())
+
+
+class FigureSlot:
+    """
+    Placeholder for a plotly figure in streamed rendering (see HtmlRenderer.generate).
+    The figure is converted by jinja_finalize when output and then dropped.
+    """
+
+    def __init__(self, fig, lazy=None):
+        self.fig = fig
+        self.lazy = lazy
+
+    def html(self):
+        if self.fig is None:
+            logging.warning('Figure already rendered, streamed figures can only be output once')
+            return ''
+        fig, self.fig = self.fig, None
+        return plhtml(fig, lazy=self.lazy)
+
+
+class Deferred:
+    """
+    Result of a thunk being evaluated in the background (see HtmlRenderer.prefetch_thunks), output by jinja_finalize
+    """
+
+    def __init__(self, future):
+        self.future = future
+
+    def html(self):
+        return jinja_finalize(self.future.result())
+
+
+class ThunkSlot:
+    """
+    Placeholder for a callable/awaitable in data, evaluated by jinja_finalize when output
+    with the options of the render (see slot_thunks)
+    """
+
+    def __init__(self, thunk, lazy=None):
+        self.thunk = thunk
+        self.lazy = lazy
+
+    def html(self):
+        return jinja_finalize(evaluate_thunk_html(self.thunk, lazy=self.lazy))
+
+
+def slot_thunks(data, lazy=None):
+    """
+    Replace the callables/awaitables left in data by ThunkSlots, so figures they return are
+    converted with the render's lazy setting
+    """
+    for parent, k, path in find_dict_thunks(data):
+        parent[k] = ThunkSlot(parent[k], lazy=lazy)
+
+
+def is_thunk(value):
+    """
+    Callables and awaitables in the data dict are evaluated only when output
+    """
+    if isinstance(value, (Undefined, type)):
+        return False
+    return callable(value) or inspect.isawaitable(value)
+
+
+def evaluate_thunk(value):
+    """
+    Call a callable and await an awaitable (in a new event loop) until a plain value results
+    """
+    while is_thunk(value):
+        if inspect.isawaitable(value):
+            value = run_awaitable(value)
+        else:
+            value = value()
+    return value
+
+
+def evaluate_thunk_html(value, lazy=None):
+    value = evaluate_thunk(value)
+    if isinstance(value, go.Figure):
+        return plhtml(value, lazy=lazy)
+    return value
+
+
+async def _await(aw):
+    return await aw
+
+
+def run_awaitable(aw):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(_await(aw))
+
+    # called from within an event loop (which is blocked rendering), so await in a separate thread
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        return ex.submit(asyncio.run, _await(aw)).result()
+
+
+def find_dict_thunks(d, path=()):
+    """
+    Given a (nested) dict, return a list of (dict, key, path) for every callable/awaitable in it,
+    where path is the tuple of keys leading to it
+    """
+    res = []
+    for k, v in d.items():
+        if is_thunk(v):
+            res.append((d, k, path + (k,)))
+        if isinstance(v, dict):
+            res.extend(find_dict_thunks(v, path + (k,)))
+
+    return res
+
+
+def referenced_data_paths(env, template):
+    """
+    Return the set of key paths a template (and templates it extends/includes) reads from data,
+    eg {{ data.sub['ch1'] }} gives ('sub', 'ch1'). All prefixes of each path are included
+    """
+    res = set()
+    for source in template_sources(env, template):
+        for node in env.parse(source).find_all((nodes.Getattr, nodes.Getitem)):
+            path = []
+            while isinstance(node, (nodes.Getattr, nodes.Getitem)):
+                if isinstance(node, nodes.Getattr):
+                    path.append(node.attr)
+                elif isinstance(node.arg, nodes.Const):
+                    path.append(node.arg.value)
+                else:
+                    path = None
+                    break
+                node = node.node
+            if path and isinstance(node, nodes.Name) and node.name == 'data':
+                path = tuple(reversed(path))
+                res.update(path[:i] for i in range(1, len(path) + 1))
+
+    return res
+
+
+def template_sources(env, name, seen=None):
+    """
+    Return the source of a template and of all templates it extends/includes/imports
+    """
+    seen = seen if seen is not None else set()
+    if name in seen:
+        return []
+    seen.add(name)
+
+    source = env.loader.get_source(env, name)[0]
+    res = [source]
+    for ref in sorted(x for x in meta.find_referenced_templates(env.parse(source)) if x is not None):
+        res.extend(template_sources(env, ref, seen))
+    return res
+
+
+renderers = {}
+renderers_lock = threading.Lock()
+
+
+def get_renderer(template_dir=None, package_loader_name=None):
+    """
+    Return a shared HtmlRenderer for the given template location, creating it on first use
+    """
+    key = (package_loader_name, None if package_loader_name else template_dir)
+    with renderers_lock:
+        if key not in renderers:
+            renderers[key] = HtmlRenderer(template_dir=template_dir, package_loader_name=package_loader_name)
+        return renderers[key]
+
+
 def jinja_finalize(value):
     """
     Finalize for jinja which makes empty entries show as blank rather than none
-    and converts plotly charts to html divs
+    and converts plotly charts to html divs. Callables/awaitables are evaluated first
     :param value:
     :return:
     """
@@ -55,13 +577,26 @@ def jinja_finalize(value):
         return ''
     if isinstance(value, go.Figure):
         return plhtml(value)
+    if isinstance(value, (FigureSlot, Deferred, ThunkSlot)):
+        return value.html()
+    if is_thunk(value):
+        return jinja_finalize(evaluate_thunk(value))
     return value
 
 
-def convert_dict_plotly_fig_png(d):
+def convert_dict_plotly_fig_png(d, exporter=None):
     """
     Given a dict (that might be passed to jinja), convert all plotly figures png
+    :param d:
+    :param exporter: ImageExporter used to convert all figures in one batch (eg in parallel and/or cached)
     """
+    if exporter is not None:
+        figs = find_dict_plotly_figs(d)
+        images = exporter.to_images([fig for parent, k, fig in figs])
+        for (parent, k, fig), image in zip(figs, images):
+            parent[k] = img_tag(image, exporter.format)
+        return d
+
     for k, v in d.items():
         if isinstance(d[k], go.Figure):
             d[k] = plpng(d[k])
@@ -71,37 +606,536 @@ def convert_dict_plotly_fig_png(d):
     return d
 
 
-def plpng(fig):
+def plpng(fig, exporter=None):
     """
     Given a plotly figure, return it as a png
     """
-    image = base64.b64encode(pl.io.to_image(fig)).decode("ascii")
-    res = f'<img src="data:image/png;base64,{image}">'
-    return res
+    if exporter is not None:
+        return img_tag(exporter.to_images([fig], format='png')[0], 'png')
+
+    return img_tag(pl.io.to_image(fig), 'png')
+
+
+image_mime_types = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'webp': 'image/webp',
+                    'svg': 'image/svg+xml'}
+
+
+def img_tag(image, format='png'):
+    """
+    Given image bytes, return an img tag with the image inlined as a data uri
+    """
+    image = base64.b64encode(image).decode("ascii")
+    return f'<img src="data:{image_mime_types[format]};base64,{image}">'
 
 
-def convert_dict_plotly_fig_html_div(d):
+def export_image(fig_json, **kwargs):
+    """
+    Render a figure (as json) to an image, defined at module level so it can run in worker processes
+    """
+    return pl.io.to_image(json.loads(fig_json), validate=False, **kwargs)
+
+
+class ImageExporter:
+    """
+    Batch static image export (png/svg etc) of plotly figures.
+    Figures are rasterised in a pool of worker processes which is kept alive between calls, so each
+    worker starts its image exporter once. Images can be cached on disk keyed on the figure content.
+    """
+
+    def __init__(self, format='png', width=None, height=None, scale=None, n_jobs=None, cache_dir=None,
+                 cache_maxbytes: int = 512 * 1024 * 1024):
+        """
+        :param format: image format, eg png or svg
+        :param width: image width in pixels, None for the figure/plotly default
+        :param height: image height in pixels
+        :param scale: scale factor applied to the image size
+        :param n_jobs: number of worker processes, -1 for one per cpu. None or 1 exports in this process
+        :param cache_dir: directory for the image cache, None to disable caching
+        :param cache_maxbytes: total size of the image cache before least recently used images are removed
+        """
+        self.format = format
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.n_jobs = n_jobs
+        self.cache = None
+        if cache_dir:
+            self.cache = DiskCache(cache_dir, maxbytes=cache_maxbytes, suffix='.img')
+        self._pool = None
+
+    def _executor(self):
+        if self.n_jobs in [None, 1]:
+            return None
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=None if self.n_jobs == -1 else self.n_jobs)
+        return self._pool
+
+    def to_images(self, figs, format=None, scale=None):
+        """
+        Export figures to images
+        :param figs: list of plotly figures
+        :param format: override the exporter's format
+        :param scale: override the exporter's scale
+        :return: list of image bytes in the order of figs
+        """
+        opts = dict(format=format or self.format, width=self.width, height=self.height,
+                    scale=self.scale if scale is None else scale)
+        fig_jsons = [fig.to_json() for fig in figs]
+        res = [None] * len(figs)
+
+        keys = []
+        if self.cache is not None:
+            keys = [json_hash(x, sorted(opts.items())) for x in fig_jsons]
+            res = [self.cache.get_bytes(key) for key in keys]
+
+        todo = [i for i, x in enumerate(res) if x is None]
+        images = cpu.parallel_map(partial(export_image, **opts), [fig_jsons[i] for i in todo],
+                                  executor=self._executor())
+        for i, image in zip(todo, images):
+            res[i] = image
+            if self.cache is not None:
+                self.cache.put_bytes(keys[i], image)
+
+        return res
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def convert_dict_plotly_fig_html_div(d, n_jobs=None, executor=None, threads=False, lazy=None, cache=None):
     """
     Given a dict (that might be passed to jinja), convert all plotly figures of html divs
+    Figures are replaced in place. Pass n_jobs (or a concurrent.futures executor) to convert in parallel
+    :param d:
+    :param n_jobs: number of workers, -1 for one per cpu. None converts serially
+    :param executor:
+    :param threads: use threads rather than processes when starting workers
+    :param lazy: emit deferred chart payloads, see plhtml
+    :param cache: fragment cache, see plhtml. Lookups are made here so only uncached figures are sent to workers
+    :return:
     """
-    for k, v in d.items():
-        if isinstance(d[k], go.Figure):
-            d[k] = plhtml(d[k])
-        if isinstance(d[k], dict):
-            convert_dict_plotly_fig_html_div(d[k])
+    figs = find_dict_plotly_figs(d)
+    # resolved here as worker processes may not share the module settings
+    options = dict(binary=binary_arrays, float32=binary_float32, lazy=lazy_charts if lazy is None else lazy)
+    cache = cache if cache is not None else fragment_cache
+
+    divs = [None] * len(figs)
+    keys = []
+    if cache:
+        for i, (parent, k, fig) in enumerate(figs):
+            format_fig(fig)
+            keys.append(cache.key(fig, options['binary'], options['float32'], options['lazy']))
+            divs[i] = cache.get(keys[i])
+
+    misses = [i for i, div in enumerate(divs) if div is None]
+    rendered = cpu.parallel_map(partial(plhtml, cache=False, **options), [figs[i][2] for i in misses],
+                                executor=executor, n_jobs=n_jobs, threads=threads)
+    for i, div in zip(misses, rendered):
+        divs[i] = div
+        if cache:
+            cache.put(keys[i], div)
+
+    for (parent, k, fig), div in zip(figs, divs):
+        parent[k] = div
 
     return d
 
 
-def plhtml(fig, margin=narrow_margin, **kwargs):
+def find_dict_plotly_figs(d):
+    """
+    Given a (nested) dict, return a list of (dict, key, figure) for every plotly figure in it
+    """
+    res = []
+    for k, v in d.items():
+        if isinstance(v, go.Figure):
+            res.append((d, k, v))
+        if isinstance(v, dict):
+            res.extend(find_dict_plotly_figs(v))
+
+    return res
+
+
+def plhtml(fig, margin=narrow_margin, cache=None, binary=None, float32=None, lazy=None, **kwargs):
     """
     Given a plotly figure, return it as a div
+    If a fragment cache is given (or set up with enable_fragment_cache) previously rendered divs are reused,
+    pass cache=False to bypass the shared cache
+    :param binary: encode numeric trace arrays as base64 typed arrays, see binary_arrays. Requires plotly.js >= 2.28
+    :param float32: downcast float arrays to float32 when binary encoding, see binary_float32
+    :param lazy: emit the chart as a deferred payload, plotted by lazy_charts_script when scrolled into view
     """
     if fig is not None:
-        fig.update_layout(margin=margin)
+        format_fig(fig, margin=margin)
 
-        fig.update_xaxes(automargin=True)
-        fig.update_yaxes(automargin=True)
-        return pl.offline.plot(fig, include_plotlyjs=False, output_type='div')
+        binary = binary_arrays if binary is None else binary
+        float32 = binary_float32 if float32 is None else float32
+        lazy = lazy_charts if lazy is None else lazy
+
+        cache = cache if cache is not None else fragment_cache
+        if not cache:
+            return fig_to_div(fig, binary, float32, lazy)
+
+        key = cache.key(fig, binary, float32, lazy)
+        div = cache.get(key)
+        if div is None:
+            div = fig_to_div(fig, binary, float32, lazy)
+            cache.put(key, div)
+        return div
 
     return ''
+
+
+def format_fig(fig, margin=narrow_margin):
+    """
+    Apply the page layout of chart divs (margins) to a figure, in place
+    """
+    fig.update_layout(margin=margin)
+
+    fig.update_xaxes(automargin=True)
+    fig.update_yaxes(automargin=True)
+
+
+# defaults for plhtml binary encoding of trace arrays
+binary_arrays = False
+binary_float32 = False
+
+# trace attributes encoded as typed arrays in binary mode
+binary_array_attrs = ['x', 'y', 'z', 'customdata']
+
+
+# default for plhtml/render_html lazy (in-browser) chart rendering
+lazy_charts = False
+
+
+def fig_to_div(fig, binary=False, float32=False, lazy=False):
+    if lazy:
+        return lazy_div(encode_fig_arrays(fig, float32=float32) if binary else fig.to_plotly_json())
+    if not binary:
+        return pl.offline.plot(fig, include_plotlyjs=False, output_type='div')
+
+    # serialised by plotly's json engine, which is orjson when installed
+    return pl.offline.plot(encode_fig_arrays(fig, float32=float32), include_plotlyjs=False, output_type='div',
+                           validate=False)
+
+
+def lazy_div(fig_dict):
+    """
+    Return a chart as an empty placeholder div plus its figure json in an inert script block.
+    The page must include lazy_charts_script, which plots the chart when it is scrolled into view
+    """
+    divid = str(uuid.uuid4())
+    height = fig_dict.get('layout', {}).get('height') or 450  # placeholder keeps the page layout until plotted
+    payload = pl.io.json.to_json_plotly(dict(data=fig_dict.get('data', []), layout=fig_dict.get('layout', {}),
+                                             config={'responsive': True}))
+    payload = payload.replace('</', '<\\/')  # keep the json from closing the script block
+    return ('<div id="{id}" class="plotly-graph-div commodplot-lazy" style="height:{height}px; width:100%;"></div>'
+            '<script type="application/json" id="{id}-data">{payload}</script>').format(id=divid, height=height,
+                                                                                       payload=payload)
+
+
+# plots the deferred charts emitted by lazy_div as they come into view, include once after the charts
+lazy_charts_script = """<script type="text/javascript">
+(function () {
+    function plot(div) {
+        var payload = document.getElementById(div.id + '-data');
+        var fig = JSON.parse(payload.textContent);
+        payload.parentNode.removeChild(payload);
+        Plotly.newPlot(div, fig.data, fig.layout, fig.config);
+    }
+    var divs = Array.prototype.slice.call(document.querySelectorAll('div.commodplot-lazy'));
+    if (!('IntersectionObserver' in window)) {
+        divs.forEach(plot);
+        return;
+    }
+    var observer = new IntersectionObserver(function (entries) {
+        entries.forEach(function (entry) {
+            if (entry.isIntersecting) {
+                observer.unobserve(entry.target);
+                plot(entry.target);
+            }
+        });
+    }, {rootMargin: '200px'});
+    divs.forEach(function (div) { observer.observe(div); });
+})();
+</script>"""
+
+
+def encode_fig_arrays(fig, float32=False):
+    """
+    Return the figure as a dict with numeric x/y/z arrays of each trace replaced by plotly.js typed array
+    specs ({'dtype': .., 'bdata': base64}), which are much smaller in the page and faster for the browser to parse.
+    Non-numeric arrays (eg dates or category labels) are left as they are.
+    :param fig:
+    :param float32: downcast float64 arrays to float32, halving their size
+    :return:
+    """
+    d = fig.to_plotly_json()
+    d['data'] = [dict(trace) for trace in d['data']]
+    for trace in d['data']:
+        for attr in binary_array_attrs:
+            if attr in trace:
+                trace[attr] = encode_array(trace[attr], float32=float32)
+
+    return d
+
+
+def encode_array(values, float32=False):
+    """
+    Encode a numeric array as a plotly.js typed array spec, returning values unchanged when not numeric
+    """
+    if isinstance(values, (str, dict)) or not hasattr(values, '__len__'):
+        return values
+    arr = np.asarray(values)
+    if arr.dtype.kind == 'M' or (arr.dtype.kind == 'O' and len(arr) and isinstance(arr[0], (date, np.datetime64))):
+        return compact_dates(arr)
+    if arr.dtype.kind == 'O':
+        try:
+            arr = arr.astype(float)  # lists of numbers with None for gaps
+        except (TypeError, ValueError):
+            return values
+    if arr.ndim != 1 or arr.dtype.kind not in 'fiu':
+        return values
+
+    if arr.dtype.kind == 'f':
+        arr = arr.astype('f4' if float32 else 'f8')
+    elif arr.dtype.itemsize > 4:
+        arr = arr.astype('f8')  # plotly.js has no 64 bit integer arrays
+    arr = arr.astype(arr.dtype.newbyteorder('<'))
+    return {'dtype': arr.dtype.str[1:], 'bdata': base64.b64encode(arr.tobytes()).decode('ascii')}
+
+
+def compact_dates(arr):
+    """
+    Dates have no typed array form in plotly.js, but daily dates can be sent without the time part
+    """
+    try:
+        idx = pd.DatetimeIndex(arr)
+    except (TypeError, ValueError):
+        return arr
+    if idx.tz is not None or not (idx == idx.normalize()).all():
+        return arr
+    return list(idx.strftime('%Y-%m-%d'))
+
+
+class DiskCache:
+    """
+    On-disk cache of rendered output (bytes) keyed by a content hash, one file per entry.
+    Least recently used entries are evicted once the total size of the cache exceeds maxbytes.
+    """
+
+    suffix = '.cache'
+
+    def __init__(self, directory, maxbytes: int = 512 * 1024 * 1024, suffix=None):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        if suffix:
+            self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.currbytes = sum(os.path.getsize(x) for x in self._files())
+
+    def _files(self):
+        return [os.path.join(self.directory, x) for x in os.listdir(self.directory) if x.endswith(self.suffix)]
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get_bytes(self, key):
+        """
+        Return the cached bytes for key, or None if not cached
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fh:
+                value = fh.read()
+            os.utime(path)  # mark as recently used
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put_bytes(self, key, value):
+        path = self._path(key)
+        tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp, 'wb') as fh:
+            fh.write(value)
+        with self._lock:
+            if os.path.exists(path):
+                self.currbytes -= os.path.getsize(path)
+            os.replace(tmp, path)
+            self.currbytes += len(value)
+            if self.currbytes > self.maxbytes:
+                self._evict()
+
+    def _evict(self):
+        files = sorted(self._files(), key=os.path.getmtime)
+        for f in files:
+            if self.currbytes <= self.maxbytes:
+                break
+            size = os.path.getsize(f)
+            os.remove(f)
+            self.currbytes -= size
+
+    def clear(self):
+        with self._lock:
+            for f in self._files():
+                os.remove(f)
+            self.currbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio(),
+            'currbytes': self.currbytes,
+            'maxbytes': self.maxbytes,
+        }
+
+
+class HtmlFragmentCache(DiskCache):
+    """
+    On-disk cache of rendered chart divs, keyed by a hash of the figure json (which includes the margins)
+    """
+
+    suffix = '.html'
+
+    @staticmethod
+    def key(fig, *args):
+        return figure_hash(fig, *args)
+
+    def get(self, key):
+        """
+        Return the cached div for key, with a new div id, see new_div_id
+        """
+        div = self.get_bytes(key)
+        if div is None:
+            return None
+
+        return new_div_id(div.decode('utf8'))
+
+    def put(self, key, div):
+        self.put_bytes(key, div.encode('utf8'))
+
+
+class MemoryFragmentCache:
+    """
+    In-memory counterpart of HtmlFragmentCache for long running processes (eg dashserver).
+    Least recently used divs are evicted once their total size exceeds maxbytes.
+    """
+
+    def __init__(self, maxbytes: int = 256 * 1024 * 1024):
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.currbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(fig, *args):
+        return figure_hash(fig, *args)
+
+    def get(self, key):
+        with self._lock:
+            div = self._entries.get(key)
+            if div is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return new_div_id(div)
+
+    def put(self, key, div):
+        with self._lock:
+            if key in self._entries:
+                self.currbytes -= len(self._entries.pop(key))
+            self._entries[key] = div
+            self.currbytes += len(div)
+            while self.currbytes > self.maxbytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.currbytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.currbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio(),
+            'entries': len(self._entries),
+            'currbytes': self.currbytes,
+            'maxbytes': self.maxbytes,
+        }
+
+
+def new_div_id(div):
+    """
+    Give a cached chart div a new id, so a chart can appear on a page more than once
+    """
+    divid = re.search(r'<div id="([^"]+)"', div)
+    if divid:
+        div = div.replace(divid.group(1), str(uuid.uuid4()))
+    return div
+
+
+def figure_hash(fig, *args):
+    """
+    Content hash of a plotly figure (its json) plus the plotly version and any extra arguments affecting output
+    """
+    return json_hash(fig.to_json(), *args)
+
+
+def json_hash(fig_json, *args):
+    h = hashlib.sha256(fig_json.encode('utf8'))
+    h.update(repr((pl.__version__, args)).encode())
+    return h.hexdigest()
+
+
+# shared fragment cache used by plhtml (and so jinja_finalize/render_html), disabled unless enabled
+fragment_cache = None
+
+
+def enable_fragment_cache(directory, maxbytes: int = 512 * 1024 * 1024):
+    """
+    Cache rendered chart divs on disk, so unchanged charts are not re-serialised between runs
+    :param directory:
+    :param maxbytes: total size of the cache before least recently used fragments are removed
+    :return: the cache, eg to log cache.stats()
+    """
+    global fragment_cache
+    fragment_cache = HtmlFragmentCache(directory, maxbytes=maxbytes)
+    return fragment_cache
+
+
+def disable_fragment_cache():
+    global fragment_cache
+    fragment_cache = None
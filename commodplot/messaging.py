@@ -1,13 +1,26 @@
+import asyncio
+import atexit
+import copy
+import json
 import logging
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
 from email.mime.application import MIMEApplication
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.utils import make_msgid
+from email.utils import getaddresses, make_msgid
+from html import escape
 from os import environ
 from pathlib import Path
-from smtplib import SMTP, SMTPException
-from typing import Union
+from queue import Empty, Full, Queue
+from smtplib import SMTP, SMTPException, SMTPRecipientsRefused, SMTPResponseException, SMTPServerDisconnected
+from typing import Dict, List, Optional, Tuple, Union
+
+from commodplot import jinjautils
 
 logger = logging.getLogger(__name__)
 
@@ -36,7 +49,6 @@ class EmailBuilder:
 
     def set_body(self, body: str, content_type: str = "html"):
         self.message.attach(MIMEText(body, content_type))
-        self.message.set
         return self
 
     def attach_file(self, file_name: str, attachment_name: str = None, content_id: str = None):
@@ -71,9 +83,10 @@ class EmailBuilder:
         return self.message.as_string()
 
 
-def compose_and_send_report(subject: str, content: str) -> None:
+def compose_and_send_report(subject: str, content: str, queue: "EmailQueue" = None) -> None:
     """
     Compose an e-mail message containing the report and send.
+    If an EmailQueue is given the message is queued for background delivery instead.
 
     Configuration:
     * ENV: SENDER_EMAIL - email address of the sender
@@ -95,6 +108,11 @@ def compose_and_send_report(subject: str, content: str) -> None:
         .set_body(content)
         .build()
     )
+    if queue is not None:
+        logger.info("Queueing report e-mail to %s", receiver_email)
+        queue.put_raw(sender_email, [receiver_email], message)
+        return
+
     logger.info("Sending report e-mail to %s", receiver_email)
     try:
         with SMTP(smtp_host, smtp_port, timeout=smtp_timeout) as client:
@@ -103,3 +121,409 @@ def compose_and_send_report(subject: str, content: str) -> None:
         logger.info("Report sent successfully")
     except SMTPException:
         logger.exception("Failed to send a report")
+
+
+def report_email(
+    data: dict,
+    template: str,
+    package_loader_name: str = None,
+    template_globals: dict = None,
+    exporter=None,
+    max_bytes: int = 10 * 1024 * 1024,
+    scales: Tuple[float, ...] = (1.0, 0.75, 0.5),
+) -> Tuple[EmailBuilder, dict]:
+    """
+    Render a report for e-mail: figures in data are rasterised (in parallel, see jinjautils.ImageExporter)
+    and attached as inline images referenced by cid: rather than embedded as data: uris.
+
+    If the message would exceed max_bytes the images are exported again at each of the smaller scales,
+    then the largest images are dropped (replaced by a note) until it fits. A summary is logged and returned.
+    Set sender, receiver and subject on the returned EmailBuilder before sending.
+    :param exporter: ImageExporter for png or jpg images, by default one worker process per cpu
+    """
+    own_exporter = exporter is None
+    exporter = exporter or jinjautils.ImageExporter(n_jobs=-1)
+    figs = jinjautils.find_dict_plotly_figs(data)
+    try:
+        images = exporter.to_images([fig for _, _, fig in figs])
+        scale = scales[0]
+        for smaller in scales[1:]:
+            if sum(mime_size(len(x)) for x in images) <= max_bytes:
+                break
+            logger.info("Report images over budget, exporting at scale %s", smaller)
+            images = exporter.to_images([fig for _, _, fig in figs], scale=smaller)
+            scale = smaller
+    finally:
+        if own_exporter:
+            exporter.close()
+
+    tdirname, tfilename = os.path.split(os.path.abspath(template))
+    renderer = jinjautils.get_renderer(template_dir=tdirname, package_loader_name=package_loader_name)
+
+    def render():
+        for i, (parent, k, fig) in enumerate(figs):
+            title = escape(fig.layout.title.text or str(k))
+            if images[i] is None:
+                parent[k] = f"<p><i>Chart omitted to keep the e-mail small: {title}</i></p>"
+            else:
+                parent[k] = f'<img src="cid:{content_ids[i]}" alt="{title}">'
+        return renderer.render(data, tfilename, template_globals=template_globals)
+
+    content_ids = [f"chart{i}.{uuid.uuid4().hex}@energy.local" for i in range(len(figs))]
+    html = render()
+
+    # drop the largest images until the message fits
+    dropped = []
+    total = mime_size(len(html.encode("utf8"))) + sum(mime_size(len(x)) for x in images)
+    for i in sorted(range(len(images)), key=lambda i: len(images[i]), reverse=True):
+        if total <= max_bytes:
+            break
+        total -= mime_size(len(images[i]))
+        images[i] = None
+        dropped.append(i)
+    if dropped:
+        html = render()
+
+    message = EmailBuilder().set_body(html)
+    for content_id, image in zip(content_ids, images):
+        if image is not None:
+            message.attach_image(image, content_id)
+
+    summary = {
+        "images": len(images) - len(dropped),
+        "dropped": len(dropped),
+        "scale": scale,
+        "image_bytes": sum(len(x) for x in images if x is not None),
+        "html_bytes": len(html),
+        "max_bytes": max_bytes,
+    }
+    logger.info(
+        "Report e-mail: %d images at scale %s (%d bytes), %d dropped, %d bytes of html, budget %d bytes",
+        summary["images"], scale, summary["image_bytes"], summary["dropped"], summary["html_bytes"], max_bytes,
+    )
+    return message, summary
+
+
+def mime_size(nbytes: int) -> int:
+    """Size of an attachment of nbytes once base64 encoded in a message (76 character lines)."""
+    encoded = (nbytes + 2) // 3 * 4
+    return encoded + 2 * (encoded // 76 + 1)
+
+
+@dataclass
+class SendResult:
+    """Outcome of sending one message with BatchSender."""
+
+    index: int
+    recipients: List[str]
+    ok: bool = False
+    attempts: int = 0
+    refused: Dict[str, tuple] = field(default_factory=dict)
+    error: Optional[str] = None
+    transient: bool = False  # failed, but might succeed later
+
+
+def message_addresses(message: EmailBuilder) -> Tuple[str, List[str]]:
+    """Return the sender and all recipients (To, Cc and Bcc) of a message."""
+    recipients = []
+    for header in ["To", "Cc", "Bcc"]:
+        for value in message.message.get_all(header, []):
+            recipients.extend(address for _, address in getaddresses([value]) if address)
+    return message.message["From"], recipients
+
+
+def message_envelope(message: EmailBuilder) -> Tuple[str, List[str], str]:
+    """Return the sender, all recipients and the text to deliver, without the Bcc header (as SMTP.send_message)."""
+    sender, recipients = message_addresses(message)
+    delivered = copy.copy(message.message)  # deleting headers replaces the header list, the original is unchanged
+    del delivered["Bcc"]
+    return sender, recipients, delivered.as_string()
+
+
+def is_connection_error(error: Exception) -> bool:
+    """The connection is unusable after a disconnect, a socket error or a 421 (closing) response."""
+    if isinstance(error, SMTPResponseException):
+        return error.smtp_code == 421
+    # SMTPException subclasses OSError, only plain socket errors are connection problems
+    return isinstance(error, SMTPServerDisconnected) or (
+        isinstance(error, OSError) and not isinstance(error, SMTPException)
+    )
+
+
+def is_transient(error: Exception) -> bool:
+    """Connection problems and 4xx responses are worth retrying, 5xx responses and other SMTP errors are not."""
+    if isinstance(error, SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return is_connection_error(error)
+
+
+class BatchSender:
+    """
+    Send many messages over a small pool of reused (STARTTLS, authenticated) SMTP connections.
+
+    Transient failures (dropped connections, 4xx responses) are retried with exponential backoff,
+    reconnecting only when the connection was lost. Each message gets a SendResult rather than stopping the batch.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int = 25,
+        timeout: float = 60,
+        starttls: bool = True,
+        username: str = None,
+        password: str = None,
+        pool_size: int = 1,
+        max_retries: int = 3,
+        backoff: float = 1.0,
+    ):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.connections = 0
+
+    @classmethod
+    def from_env(cls, **kwargs) -> "BatchSender":
+        """
+        Create a sender configured as compose_and_send_report.
+
+        Configuration:
+        * ENV: SMTP_HOST, SMTP_PORT, SMTP_TIMEOUT - as for compose_and_send_report
+        * ENV: SMTP_USER, SMTP_PASSWORD - login, if required by the server
+        """
+        settings = dict(
+            host=environ.get("SMTP_HOST"),
+            port=int(environ.get("SMTP_PORT", "25")),
+            timeout=int(environ.get("SMTP_TIMEOUT", "60")),
+            username=environ.get("SMTP_USER"),
+            password=environ.get("SMTP_PASSWORD"),
+        )
+        settings.update(kwargs)
+        return cls(**settings)
+
+    def connect(self) -> SMTP:
+        client = SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                client.starttls()
+            if self.username:
+                client.login(self.username, self.password)
+        except Exception:
+            client.close()
+            raise
+        self.connections += 1
+        return client
+
+    def send(self, messages: List[EmailBuilder]) -> List[SendResult]:
+        """Send all messages, returning a result per message in the same order."""
+        return self.send_raw([message_envelope(message) for message in messages])
+
+    def send_raw(self, messages: List[Tuple[str, List[str], str]]) -> List[SendResult]:
+        """Send already built messages, given as (sender, recipients, message text)."""
+        results = []
+        work = Queue()
+        for index, (sender, recipients, message) in enumerate(messages):
+            results.append(SendResult(index, recipients))
+            work.put((results[-1], sender, message))
+
+        nworkers = min(self.pool_size, len(messages))
+        workers = [threading.Thread(target=self._worker, args=(work,)) for _ in range(nworkers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        sent = len([x for x in results if x.ok])
+        logger.info("Sent %d of %d messages over %d connections", sent, len(results), self.connections)
+        return results
+
+    def _worker(self, work: Queue) -> None:
+        client = None
+        while True:
+            try:
+                result, sender, message = work.get_nowait()
+            except Empty:
+                break
+            client = self._send_one(client, result, sender, message)
+
+        if client is not None:
+            try:
+                client.quit()
+            except (SMTPException, OSError):
+                client.close()
+
+    def _send_one(self, client: Optional[SMTP], result: SendResult, sender: str, message: str) -> Optional[SMTP]:
+        while result.attempts <= self.max_retries:
+            if result.attempts:
+                time.sleep(self.backoff * 2 ** (result.attempts - 1))
+            result.attempts += 1
+            try:
+                if client is None:
+                    client = self.connect()
+                result.refused = client.sendmail(sender, result.recipients, message)
+                result.ok = True
+                result.error = None
+                result.transient = False
+                return client
+            except Exception as e:
+                result.error = f"{type(e).__name__}: {e}"
+                result.transient = is_transient(e)
+                if is_connection_error(e) and client is not None:
+                    client.close()
+                    client = None
+                if not result.transient:
+                    break
+                logger.warning("Transient failure sending to %s, attempt %d: %s", result.recipients, result.attempts, e)
+
+        logger.error("Failed to send to %s: %s", result.recipients, result.error)
+        return client
+
+
+class EmailQueue:
+    """
+    Background delivery of messages through a BatchSender.
+
+    Messages are put on a bounded queue (put blocks when it is full) and sent in batches by worker threads,
+    so slow relays do not hold up report generation. With a spool directory each message is also written
+    to disk until it has been delivered (or permanently rejected), and spooled messages are re-queued on start.
+    Pending messages are flushed when the queue is closed, including at interpreter exit.
+    """
+
+    def __init__(self, sender: BatchSender, maxsize: int = 100, workers: int = 1, batch_size: int = 20,
+                 spool_dir: str = None):
+        self.sender = sender
+        self.batch_size = batch_size
+        self.spool_dir = spool_dir
+        self.queue = Queue(maxsize=maxsize)
+        self.counts = {"enqueued": 0, "sent": 0, "failed": 0, "spooled": 0, "retries": 0}
+        self.latency = 0.0  # total seconds from enqueue to delivery, see metrics
+        self._lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        self._closed = False
+        for worker in self._workers:
+            worker.start()
+        atexit.register(self.close)
+
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+            for name in sorted(os.listdir(spool_dir)):
+                if name.endswith(".json"):
+                    self._load_spooled(os.path.join(spool_dir, name))
+
+    def put(self, message: EmailBuilder, block: bool = True, timeout: float = None) -> None:
+        """Queue a message, waiting for space when the queue is full (raises queue.Full after timeout)."""
+        self.put_raw(*message_envelope(message), block=block, timeout=timeout)
+
+    def put_raw(self, sender: str, recipients: List[str], message: str, block: bool = True,
+                timeout: float = None) -> None:
+        """Queue an already built message."""
+        if self._closed:
+            raise RuntimeError("EmailQueue is closed")
+        # spooled before queueing, as a worker may deliver (and unspool) the message as soon as it is queued
+        spool = self._spool(sender, recipients, message) if self.spool_dir else None
+        try:
+            self.queue.put((time.monotonic(), sender, recipients, message, spool), block=block, timeout=timeout)
+        except Full:
+            if spool:  # not queued, so not left to be re-sent after a restart
+                os.remove(spool)
+                with self._lock:
+                    self.counts["spooled"] -= 1
+            raise
+        with self._lock:
+            self.counts["enqueued"] += 1
+
+    async def put_async(self, message: EmailBuilder) -> None:
+        """Queue a message from a coroutine, waiting for space without blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(None, self.put, message)
+
+    def _spool(self, sender: str, recipients: List[str], message: str) -> str:
+        path = os.path.join(self.spool_dir, f"{time.time_ns()}-{uuid.uuid4().hex}.json")
+        with open(path + ".tmp", "w", encoding="utf8") as fh:
+            json.dump({"sender": sender, "recipients": recipients, "message": message}, fh)
+        os.replace(path + ".tmp", path)
+        with self._lock:
+            self.counts["spooled"] += 1
+        return path
+
+    def _load_spooled(self, path: str) -> None:
+        with open(path, encoding="utf8") as fh:
+            item = json.load(fh)
+        logger.info("Re-queueing spooled e-mail to %s", item["recipients"])
+        self.queue.put((time.monotonic(), item["sender"], item["recipients"], item["message"], path))
+        with self._lock:
+            self.counts["enqueued"] += 1
+
+    def _worker(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            stop = batch[-1] is None
+            items = [x for x in batch if x is not None]
+            if items:
+                self._deliver(items)
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                return
+
+    def _deliver(self, items: list) -> None:
+        try:
+            results = self.sender.send_raw([item[1:4] for item in items])  # (sender, recipients, message)
+        except Exception as e:  # keep the worker alive, messages stay spooled
+            logger.exception("Failed to deliver queued e-mails")
+            results = [SendResult(i, x[2], error=str(e), transient=True) for i, x in enumerate(items)]
+
+        now = time.monotonic()
+        with self._lock:
+            for (queued, _, _, _, spool), result in zip(items, results):
+                self.counts["retries"] += max(result.attempts - 1, 0)
+                if result.ok:
+                    self.counts["sent"] += 1
+                    self.latency += now - queued
+                else:
+                    self.counts["failed"] += 1
+                # transient failures stay in the spool to be retried after a restart
+                if spool and not result.transient:
+                    os.remove(spool)
+
+    def flush(self) -> None:
+        """Wait until every queued message has been sent (or has failed)."""
+        self.queue.join()
+
+    def close(self) -> None:
+        """Flush pending messages and stop the workers."""
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        for _ in self._workers:
+            self.queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        logger.info("E-mail queue closed: %s", self.metrics())
+
+    def metrics(self) -> dict:
+        with self._lock:
+            res = dict(self.counts)
+            res["pending"] = self.queue.qsize()
+            res["mean_latency"] = self.latency / res["sent"] if res["sent"] else 0.0
+        return res
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
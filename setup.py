@@ -17,7 +17,7 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     install_requires=['pandas', 'plotly', 'commodutil', 'cufflinks'],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     setup_requires=['pytest-runner'],
     tests_require=['pytest'],
 )
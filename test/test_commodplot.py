@@ -1,11 +1,16 @@
+import json
 import os
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
+from commodutil import dates
 from commodutil import forwards
 
 from commodplot import commodplot
+from commodplot import commodplottrace as cptr
 
 
 class TestCommodplot(unittest.TestCase):
@@ -16,7 +21,7 @@ class TestCommodplot(unittest.TestCase):
         cl = cl.dropna(how='all', axis=1)
         fwd = pd.DataFrame([50 for x in range(12)], index=pd.date_range('2021-01-01', periods=12, freq='MS'))
 
-        res = commodplot.seas_line_plot(cl[cl.columns[-1]], fwd=fwd, shaded_range=5, visible_line_years=3,
+        res = commodplot.seas_line_plot(cl[cl.columns[-1]], fwd=fwd, shaded_range=(2015, 2019), visible_line_years=3,
                                         average_line=5)
         self.assertTrue(isinstance(res, go.Figure))
 
@@ -145,6 +150,148 @@ class TestCommodplot(unittest.TestCase):
         res = commodplot.line_plot(cl, fwd=fwd, title='Test')
         self.assertTrue(isinstance(res, go.Figure))
 
+    def test_fast_mode(self):
+        dirname, filename = os.path.split(os.path.abspath(__file__))
+        cl = pd.read_csv(os.path.join(dirname, 'test_cl.csv'), index_col=0, parse_dates=True, dayfirst=True)
+        cl = cl.dropna(how='all', axis=1)
+        chlo = pd.read_csv(os.path.join(dirname, 'test_cl_chlo.csv'), index_col=0, parse_dates=True, dayfirst=True)
+
+        charts = [
+            (commodplot.seas_line_plot, (cl[cl.columns[-1]],), {}),
+            (commodplot.line_plot, (cl[['CL_2019F', 'CL_2020G']],), {}),
+            (commodplot.stacked_area_chart, (chlo,), {}),
+            (commodplot.bar_chart, (chlo,), {'barmode': 'stack'}),
+            (commodplot.diff_plot, (chlo[['Open', 'Close']],), {}),
+            (commodplot.reindex_year_line_subplot, (2, 1, [cl[['CL_2019F', 'CL_2020F']]] * 2), {}),
+        ]
+        for func, args, kwargs in charts:
+            slow = func(*[x.copy() if isinstance(x, pd.DataFrame) else x for x in args], **kwargs)
+            fast = func(*[x.copy() if isinstance(x, pd.DataFrame) else x for x in args], fast=True, **kwargs)
+            self.assertTrue(isinstance(fast, go.Figure))
+            self.assertEqual(json.loads(slow.to_json()), json.loads(fast.to_json()), func.__name__)
+
+    def test_fast_mode_subplots(self):
+        dirname, filename = os.path.split(os.path.abspath(__file__))
+        cl = pd.read_csv(os.path.join(dirname, 'test_cl.csv'), index_col=0, parse_dates=True, dayfirst=True)
+        cl = cl.dropna(how='all', axis=1)
+
+        # the subplot grid is kept, so row/col arguments work as on the default figures
+        figs = [
+            commodplot.seas_line_subplot(1, 2, cl[['CL_2019F', 'CL_2020F']], fast=True),
+            commodplot.reindex_year_line_subplot(2, 1, [cl[['CL_2019F', 'CL_2020F']]] * 2, fast=True),
+            commodplot.diff_plot(cl[['CL_2019F', 'CL_2020F']].copy(), fast=True),
+        ]
+        for fig in figs:
+            count = len(fig.data)
+            fig.add_trace(go.Scatter(x=[1, 2], y=[1, 2]), row=1, col=1)
+            fig.update_xaxes(title='x', row=1, col=1)
+            self.assertEqual(len(fig.data), count + 1)
+            self.assertEqual(fig.get_subplot(1, 1).xaxis.title.text, 'x')
+
+    def test_hover_payload_size(self):
+        dirname, filename = os.path.split(os.path.abspath(__file__))
+        cl = pd.read_csv(os.path.join(dirname, 'test_cl.csv'), index_col=0, parse_dates=True, dayfirst=True)
+        cl = cl.dropna(how='all', axis=1)
+
+        res = commodplot.seas_line_plot(cl[cl.columns[-1]])
+        self.assertTrue(all(x.text is None for x in res.data))
+        self.assertTrue(all('%{x|%d-%b}' in x.hovertemplate for x in res.data))
+
+        # previous behaviour: a formatted date text array attached to every year line
+        legacy = go.Figure(res)
+        for trace in legacy.data:
+            trace.update(text=pd.DatetimeIndex(trace.x).strftime('%d-%b'), hovertemplate='%{y:.2f}: <i>%{text}</i>')
+
+        self.assertLess(len(res.to_json()), 0.8 * len(legacy.to_json()))
+
+    def test_seas_line_plot_update(self):
+        curyear = dates.curyear
+        dr = pd.date_range(start='{}-01-01'.format(curyear - 5), end='{}-03-10'.format(curyear), freq='B')
+        ser = pd.Series(np.arange(len(dr), dtype=float), index=dr, name='Test')
+        fwd = pd.DataFrame([50 for x in range(12)], index=pd.date_range('{}-04-01'.format(curyear), periods=12,
+                                                                        freq='MS'))
+
+        def year_lines(fig):
+            return {x.name: pd.Series(x.y, index=x.x).dropna() for x in fig.data if x.line.dash != 'dot'}
+
+        expected = commodplot.seas_line_plot(ser, fwd=fwd, title='Test')
+        # update within the current year, and from the end of last year (creating the current year line)
+        for split in [ser.index[-3], pd.Timestamp('{}-01-01'.format(curyear))]:
+            res = commodplot.seas_line_plot(ser[ser.index < split], fwd=fwd, title='Test')
+            res = commodplot.seas_line_plot_update(res, ser[ser.index >= split], fwd=fwd, title='Test')
+            self.assertEqual(expected.layout.title.text, res.layout.title.text)
+            self.assertEqual([x.name for x in expected.data], [x.name for x in res.data])
+            for name, line in year_lines(expected).items():
+                pd.testing.assert_series_equal(line, year_lines(res)[name])
+
+        # cached trace state rather than a figure
+        traces = cptr.seas_plot_traces(ser[:-3], histfreq='B')
+        res = commodplot.seas_line_plot_update(traces, ser[-3:], histfreq='B', title='Test')
+        self.assertEqual(expected.layout.title.text, res.layout.title.text)
+        self.assertEqual(pd.Series(traces['hist'][-1].y).dropna().iloc[-1], ser.iloc[-1])
+
+    def test_seas_line_plot_update_monthly(self):
+        curyear = dates.curyear
+        dr = pd.date_range(start='{}-01-01'.format(curyear - 5), end='{}-03-01'.format(curyear), freq='MS')
+        ser = pd.Series(np.arange(len(dr), dtype=float), index=dr, name='Test')
+        fwd = pd.DataFrame([50 for x in range(12)], index=pd.date_range('{}-04-01'.format(curyear), periods=12,
+                                                                        freq='MS'))
+
+        expected = commodplot.seas_line_plot(ser, fwd=fwd, title='Test')
+        res = commodplot.seas_line_plot(ser[:-2], fwd=fwd, title='Test')
+        res = commodplot.seas_line_plot_update(res, ser[-2:], fwd=fwd, title='Test')
+        expected_fwd = [x for x in expected.data if x.line.dash == 'dot']
+        res_fwd = [x for x in res.data if x.line.dash == 'dot']
+        self.assertEqual([x.name for x in expected_fwd], [x.name for x in res_fwd])
+        for e, r in zip(expected_fwd, res_fwd):
+            self.assertEqual(len(e.x), len(r.x))
+            self.assertEqual(e.hovertemplate, r.hovertemplate)
+
+    def test_subplot_parallel(self):
+        dr = pd.date_range(start='2015', end='2020-12-31', freq='B')
+        data = {'A': [10 for x in dr], 'B': [20 for x in dr], 'C': [30 for x in dr], 'D': [10 for x in dr]}
+        df = pd.DataFrame(data, index=dr)
+
+        serial = commodplot.seas_line_subplot(2, 2, df, subplot_titles=['1', '2', '3', '4'])
+        res = commodplot.seas_line_subplot(2, 2, df, subplot_titles=['1', '2', '3', '4'], n_jobs=2)
+        self.assertEqual(json.loads(serial.to_json()), json.loads(res.to_json()))
+
+        data = {'Q1 2019': [10 for x in dr], 2020: [20 for x in dr], 2021: [30 for x in dr]}
+        dfs = [pd.DataFrame(data, index=dr) for x in range(1, 3)]
+        serial = commodplot.reindex_year_line_subplot(1, 2, dfs)
+        with ThreadPoolExecutor(2) as executor:
+            res = commodplot.reindex_year_line_subplot(1, 2, dfs, executor=executor, fast=True)
+        self.assertEqual(json.loads(serial.to_json()), json.loads(res.to_json()))
+
+    def test_panel_kwargs(self):
+        threshold = cptr.webgl_threshold
+        try:
+            cptr.webgl_threshold = 1000
+            res = commodplot.panel_kwargs(dict(n_jobs=2, title='a'), showlegend=False)
+            self.assertEqual(res, dict(title='a', fast=True, webgl_threshold=1000, showlegend=False))
+
+            cptr.webgl_threshold = None
+            res = commodplot.panel_kwargs(dict(webgl_threshold=50))
+            self.assertEqual(res, dict(fast=cptr.fast_mode, webgl_threshold=50))
+            self.assertFalse(commodplot.panel_kwargs({})['webgl_threshold'])
+        finally:
+            cptr.webgl_threshold = threshold
+
+    def test_seas_line_plot_batch(self):
+        dr = pd.date_range(start='2012-01-01', end='2020-06-30', freq='B')
+        rs = np.random.RandomState(0)
+        df = pd.DataFrame(rs.randn(len(dr), 3).cumsum(axis=0), index=dr, columns=['A', 'B', 'C'])
+        df.loc[:'2013-06-30', 'B'] = np.nan  # shorter history
+        df.iloc[100:110, 2] = np.nan  # gap
+        fwd = pd.DataFrame({'A': [50 for x in range(12)]}, index=pd.date_range('2020-07-01', periods=12, freq='MS'))
+
+        kwargs = dict(shaded_range=(2014, 2019), average_line=(2014, 2019), shaded_percentiles=(10, 90))
+        res = commodplot.seas_line_plot_batch(df, fwd=fwd, **kwargs)
+        self.assertEqual(list(res.keys()), ['A', 'B', 'C'])
+        for col in df.columns:
+            expected = commodplot.seas_line_plot(df[col], fwd=fwd[col] if col in fwd else None, title=col, **kwargs)
+            self.assertEqual(json.loads(expected.to_json()), json.loads(res[col].to_json()), col)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,7 @@
+import re
 import unittest
 
+import numpy as np
 import pandas as pd
 
 from commodplot import commodplottable as cpt
@@ -16,6 +18,22 @@ class TestCommodplotTable(unittest.TestCase):
         res = cpt.generate_table(df, accounting_col_columns=['Bar'])
         self.assertIn('<style type="text/css">', res)
 
+    def test_generate_table_fast(self):
+        df = pd.DataFrame(
+            [[1, 2.5, 'a', 4.0], [5, 6.0, 'b', 8.0], [3, -5.25, 'c', np.nan]],
+            columns=['Foo', 'Bar', 'Buzz', 'Fuzz'],
+            index=pd.Index(['First', 'Second', 'Third'], name='Name'),
+        )
+        for precision in [None, 4]:
+            styler = cpt.generate_table(df, precision=precision, accounting_col_columns=['Bar'])
+            fast = cpt.generate_table(df, precision=precision, accounting_col_columns=['Bar'], fast=True)
+
+            cells = r'<t[dh] [^>]*>([^<]*)</t[dh]>'
+            self.assertEqual(re.findall(cells, fast), re.findall(cells, styler))
+            self.assertEqual(re.findall(r'col1 (pos|neg)', fast), ['pos', 'pos', 'neg'])
+            for rule in ['tr:hover', 'tr:nth-child(even)', 'border-bottom: 2px solid #00cccc']:
+                self.assertIn(rule, fast)
+
 
 if __name__ == '__main__':
     unittest.main()
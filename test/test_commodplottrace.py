@@ -1,4 +1,5 @@
 import unittest
+import warnings
 
 import cufflinks as cf
 import pandas as pd
@@ -17,12 +18,76 @@ class TestCommodPlotTrace(unittest.TestCase):
         self.assertTrue(isinstance(res[0], pd.DataFrame))
         self.assertTrue(isinstance(res[1], int))
 
+    def test_band_stats(self):
+        df = cf.datagen.lines(1, 5000)
+        dft = transforms.seasonailse(df)
+        res, rangeyr = cptr.band_stats(dft, 5, percentiles=[10, 90])
+        self.assertEqual(list(res.columns), ['min', 'max', 'mean', 'p10', 'p90'])
+
+        r = cptr.clean_seas_df_for_min_max_average(dft, 5)
+        self.assertEqual(rangeyr, len(r.columns))
+        pd.testing.assert_series_equal(res['min'], r.min(axis=1), check_names=False)
+        pd.testing.assert_series_equal(res['max'], r.max(axis=1), check_names=False)
+        pd.testing.assert_series_equal(res['mean'], r.mean(axis=1), check_names=False)
+        pd.testing.assert_series_equal(res['p90'], r.quantile(0.9, axis=1), check_names=False)
+
+    def test_band_stats_single_year(self):
+        dr = pd.date_range('2019-01-01', '2019-12-31')
+        dft = transforms.seasonailse(pd.DataFrame({'a': range(len(dr))}, index=dr, dtype=float))
+        dft.iloc[:10] = None  # missing data, a single year has no spread of missing counts to compare
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            res, rangeyr = cptr.band_stats(dft, (2019, 2019))
+        self.assertIsNone(rangeyr)
+
+    def test_shaded_range_percentiles(self):
+        df = cf.datagen.lines(1, 5000)
+        dft = transforms.seasonailse(df)
+        traces = cptr.shaded_range_traces(dft, 5, percentiles=(10, 90))
+        self.assertEqual([x.name.split(' ')[-1] for x in traces], ['Max', 'Min', 'P90', 'P10'])
+
     def test_timeseries_trace(self):
         df = cf.datagen.lines(1, 5000)
         t = cptr.timeseries_trace(df[df.columns[0]])
         self.assertTrue(isinstance(t, go.Scatter))
         self.assertEqual(t.name, df.columns[0])
-        self.assertEqual(t.hovertemplate, cptr.hovertemplate_default)
+        self.assertEqual(t.hovertemplate, cptr.date_hovertemplate_default)
+
+    def test_timeseries_trace_max_points(self):
+        df = cf.datagen.lines(1, 5000)
+        series = df[df.columns[0]]
+        t = cptr.timeseries_trace(series, max_points=1000)
+        self.assertEqual(len(t.x), 1000)
+        self.assertEqual(t.y[-1], series.iloc[-1])
+
+    def test_timeseries_trace_webgl(self):
+        df = cf.datagen.lines(1, 5000)
+        series = df[df.columns[0]]
+        t = cptr.timeseries_trace(series, webgl_threshold=1000, color='red', dash='dot', legendgroup='a')
+        self.assertTrue(isinstance(t, go.Scattergl))
+        self.assertEqual(t.hovertemplate, cptr.date_hovertemplate_default)
+        self.assertEqual(t.line.color, 'red')
+        self.assertEqual(t.line.dash, 'dot')
+        self.assertEqual(t.legendgroup, 'a')
+
+        t = cptr.timeseries_trace(series, webgl_threshold=False)
+        self.assertTrue(isinstance(t, go.Scatter))
+
+        dft = transforms.seasonailse(df)
+        traces = cptr.timeseries_to_seas_trace(dft, webgl_threshold=1000)
+        self.assertTrue(all(isinstance(x, go.Scattergl) for x in traces))
+
+    def test_seas_trace_text(self):
+        df = cf.datagen.lines(1, 5000)
+        dft = transforms.seasonailse(df)
+        traces = cptr.timeseries_to_seas_trace(dft, hover_date_format='%b')
+        self.assertEqual(traces[0].hovertemplate, cptr.date_hovertemplate('%b'))
+        self.assertIsNone(traces[0].text)
+
+        text = dft.index.strftime('%d-%b')
+        traces = cptr.timeseries_to_seas_trace(dft, text)
+        self.assertEqual(traces[0].hovertemplate, cptr.hovertemplate_default)
+        self.assertEqual(list(traces[0].text), list(text))
 
     def test_timeseries_trace_by_year(self):
         df = cf.datagen.lines(1, 5000)
@@ -0,0 +1,81 @@
+import unittest
+
+import cufflinks as cf
+import numpy as np
+import pandas as pd
+
+from commodplot import commodplottransform as cpt
+
+
+class TestCommodPlotTransform(unittest.TestCase):
+
+    def setUp(self):
+        cpt.transform_cache.clear()
+
+    def test_seasonalise_cache(self):
+        df = cf.datagen.lines(1, 1000)
+
+        res1 = cpt.seasonalise(df, histfreq='B')
+        self.assertEqual(cpt.transform_cache.stats()['misses'], 1)
+        res2 = cpt.seasonalise(df.copy(), histfreq='B')  # same content, different object
+        self.assertEqual(cpt.transform_cache.stats()['hits'], 1)
+        pd.testing.assert_frame_equal(res1, res2)
+
+        res2.iloc[0, 0] = -1  # cached results are copies
+        res3 = cpt.seasonalise(df, histfreq='B')
+        pd.testing.assert_frame_equal(res1, res3)
+
+        df.iloc[-1, 0] = df.iloc[-1, 0] + 1  # changed content should miss
+        cpt.seasonalise(df, histfreq='B')
+        self.assertEqual(cpt.transform_cache.stats()['misses'], 2)
+
+        cpt.transform_cache.clear()
+        self.assertEqual(cpt.transform_cache.stats()['entries'], 0)
+
+    def test_cache_eviction(self):
+        df = cf.datagen.lines(1, 1000)
+        res = cpt.seasonalise(df, histfreq='B')
+        nbytes = cpt.transform_cache.currbytes
+
+        cache = cpt.TransformCache(maxbytes=nbytes * 2)
+        for i in range(3):
+            cache.put(i, res)
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertIsNone(cache.get(0))  # least recently used is evicted first
+        self.assertIsNotNone(cache.get(2))
+
+    def test_cache_disabled(self):
+        df = cf.datagen.lines(1, 1000)
+        cpt.transform_cache.enabled = False
+        try:
+            cpt.seasonalise(df, histfreq='B')
+            cpt.seasonalise(df, histfreq='B')
+        finally:
+            cpt.transform_cache.enabled = True
+        self.assertEqual(cpt.transform_cache.stats()['entries'], 0)
+
+    def test_downsample(self):
+        dr = pd.date_range('2010-01-01', periods=5000, freq='D')
+        ser = pd.Series(np.sin(np.arange(len(dr)) / 50.0), index=dr, name='Test')
+        ser.iloc[123] = 5  # spike should survive downsampling
+
+        res = cpt.downsample(ser, max_points=500)
+        self.assertEqual(len(res), 500)
+        self.assertEqual(res.index[0], ser.index[0])
+        self.assertEqual(res.index[-1], ser.index[-1])
+        self.assertEqual(res.iloc[-1], ser.iloc[-1])
+        self.assertTrue(res.index.is_monotonic_increasing)
+        self.assertIn(ser.index[123], res.index)
+
+        self.assertIs(cpt.downsample(ser, max_points=None), ser)
+        self.assertIs(cpt.downsample(ser, max_points=10000), ser)
+
+        # very small budgets keep the end points
+        self.assertEqual(list(cpt.downsample(ser, max_points=2).index), [ser.index[0], ser.index[-1]])
+        self.assertEqual(list(cpt.downsample(ser, max_points=1).index), [ser.index[-1]])
+        with self.assertRaises(ValueError):
+            cpt.downsample(ser, max_points=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -34,6 +34,13 @@ class TestCommodPlotUtil(unittest.TestCase):
         self.assertTrue(res.startswith('TTitle  post:'))
         self.assertTrue(res.endswith('+1'))
 
+    def test_parallel_map(self):
+        items = list(range(10))
+        expected = [abs(-x) for x in items]
+        self.assertEqual(cpu.parallel_map(abs, items), expected)
+        self.assertEqual(cpu.parallel_map(abs, items, n_jobs=2), expected)
+        self.assertEqual(cpu.parallel_map(abs, items, n_jobs=2, threads=True), expected)
+
 
 if __name__ == '__main__':
     unittest.main()
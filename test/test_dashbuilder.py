@@ -0,0 +1,94 @@
+import gzip
+import hashlib
+import os
+import tempfile
+import unittest
+
+import plotly.express as px
+import plotly.graph_objects as go
+
+from commodplot import dashbuilder
+from commodplot import jinjautils
+
+
+class TestDashBuilder(unittest.TestCase):
+
+    def test_build(self):
+        df = px.data.gapminder().query("country=='Canada'")
+        fig = px.line(df, x="year", y="lifeExp")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            template = os.path.join(tmpdir, 'page.html')
+            with open(template, 'w') as fh:
+                fh.write('{% extends "base.html" %}{% block content %}{{ data.ch1 }}{% endblock %}')
+            with open(os.path.join(tmpdir, 'base.html'), 'w') as fh:
+                fh.write('<title>{{ pagetitle }}</title>{% block content %}{% endblock %}')
+            manifest = os.path.join(tmpdir, 'manifest.json')
+
+            def build(title='test', force=False):
+                builder = dashbuilder.DashboardBuilder(manifest=manifest, compress='gz')
+                for name in ['a', 'b']:
+                    builder.add({'name': title, 'ch1': go.Figure(fig)}, template, os.path.join(tmpdir, name + '.html'))
+                return [x['status'] for x in builder.build(force=force, n_jobs=2)]
+
+            self.assertEqual(build(), ['written', 'written'])
+            self.assertEqual(build(), ['skipped', 'skipped'])
+            self.assertEqual(build(force=True), ['unchanged', 'unchanged'])  # same output, files not rewritten
+            self.assertEqual(build(title='changed'), ['written', 'written'])
+
+            with open(os.path.join(tmpdir, 'a.html')) as fh, gzip.open(os.path.join(tmpdir, 'a.html.gz'), 'rt') as gz:
+                output = fh.read()
+                self.assertIn('id="chart-0"', output)
+                self.assertEqual(output, gz.read())
+
+            # a change to an inherited template is picked up
+            with open(os.path.join(tmpdir, 'base.html'), 'w') as fh:
+                fh.write('<h1>{{ pagetitle }}</h1>{% block content %}{% endblock %}')
+            self.assertEqual(build(title='changed'), ['written', 'written'])
+
+    def test_build_again(self):
+        df = px.data.gapminder().query("country=='Canada'")
+        fig = px.line(df, x="year", y="lifeExp")
+        titles = ['test']
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            template = os.path.join(tmpdir, 'page.html')
+            with open(template, 'w') as fh:
+                fh.write('<title>{{ data.title }}</title>{{ data.ch1 }}')
+
+            builder = dashbuilder.DashboardBuilder()
+            data = {'name': 'test', 'title': lambda: titles[-1], 'ch1': fig}
+            builder.add(data, template, os.path.join(tmpdir, 'a.html'))
+            self.assertEqual([x['status'] for x in builder.build()], ['written'])
+            self.assertIs(data['ch1'], fig)  # the page data is not replaced by rendering
+            self.assertEqual([x['status'] for x in builder.build()], ['skipped'])
+
+            titles.append('changed')  # callables are hashed on their result
+            self.assertEqual([x['status'] for x in builder.build()], ['written'])
+            with open(os.path.join(tmpdir, 'a.html')) as fh:
+                self.assertIn('<title>changed</title>', fh.read())
+
+            # a change to the output settings is picked up
+            lazy = jinjautils.lazy_charts
+            try:
+                jinjautils.lazy_charts = True
+                self.assertEqual([x['status'] for x in builder.build()], ['written'])
+            finally:
+                jinjautils.lazy_charts = lazy
+            with open(os.path.join(tmpdir, 'a.html')) as fh:
+                self.assertNotIn('Plotly.newPlot', fh.read())
+
+    def test_update_hash(self):
+        def digest(value):
+            h = hashlib.sha256()
+            dashbuilder.update_hash(h, value)
+            return h.hexdigest()
+
+        df = px.data.gapminder().query("country=='Canada'")
+        self.assertEqual(digest({'a': 1, 'b': df}), digest({'b': df.copy(), 'a': 1}))
+        self.assertNotEqual(digest({'a': 1, 'b': df}), digest({'a': 1, 'b': df.iloc[1:]}))
+        self.assertNotEqual(digest([1, [2]]), digest([[1], 2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
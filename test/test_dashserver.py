@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+
+import plotly.express as px
+
+from commodplot import dashserver
+
+
+class TestDashServer(unittest.TestCase):
+
+    def test_server(self):
+        df = px.data.gapminder().query("country=='Canada'")
+        fig = px.line(df, x="year", y="lifeExp")
+        renders = []
+
+        def data():
+            renders.append(1)
+            return {'name': 'test', 'ch1': fig}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            template = os.path.join(tmpdir, 'page.html')
+            with open(template, 'w') as fh:
+                fh.write('<title>{{ pagetitle }}</title>{{ data.ch1 }}')
+
+            server = dashserver.DashboardServer(port=0)
+            server.register('/test', data, template)
+            server.start()
+            try:
+                url = server.url + '/test'
+                with urllib.request.urlopen(url) as res:
+                    body = res.read().decode('utf8')
+                    etag = res.headers['ETag']
+                self.assertTrue(body.startswith('<title>test</title>'))
+
+                with urllib.request.urlopen(url) as res:
+                    self.assertEqual(res.headers['ETag'], etag)
+                self.assertEqual(len(renders), 1)  # served from the page cache
+
+                with self.assertRaises(urllib.error.HTTPError) as e:
+                    urllib.request.urlopen(urllib.request.Request(url, headers={'If-None-Match': etag}))
+                self.assertEqual(e.exception.code, 304)
+
+                server.invalidate('/test')
+                with urllib.request.urlopen(url) as res:
+                    self.assertEqual(res.headers['ETag'], etag)  # same content renders to the same page
+                self.assertEqual(len(renders), 2)
+                self.assertEqual(server.fragment_cache.stats()['hits'], 1)  # chart div reused
+
+                with self.assertRaises(urllib.error.HTTPError) as e:
+                    urllib.request.urlopen(server.url + '/missing')
+                self.assertEqual(e.exception.code, 404)
+            finally:
+                server.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
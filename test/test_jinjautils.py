@@ -1,7 +1,19 @@
+import asyncio
+import base64
+import gzip
+import importlib.util
+import json
 import os
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
+import numpy as np
+import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 
 from commodplot import jinjautils
 
@@ -22,6 +34,285 @@ class TestCommodPlotUtil(unittest.TestCase):
         self.assertTrue(isinstance(res['ch1'], str))
         self.assertTrue(isinstance(res['innerd']['ch2'], str))
 
+    def test_convert_dict_plotly_fig_html_div_parallel(self):
+        df = px.data.gapminder().query("country=='Canada'")
+        figs = [px.line(df, x="year", y=y) for y in ['lifeExp', 'pop', 'gdpPercap']]
+
+        data = {'ch1': figs[0], 'el': 1, 'innerd': {'ch2': figs[1], 'ch3': figs[2]}}
+        expected = [jinjautils.plhtml(go.Figure(x)) for x in figs]
+
+        for kwargs in [dict(n_jobs=2), dict(n_jobs=2, threads=True)]:
+            d = dict(data, innerd=dict(data['innerd']))
+            res = jinjautils.convert_dict_plotly_fig_html_div(d, **kwargs)
+            self.assertIs(res, d)
+            self.assertEqual(res['el'], 1)
+            # div ids are random, compare the figure json embedded in each div
+            for div, exp in zip([res['ch1'], res['innerd']['ch2'], res['innerd']['ch3']], expected):
+                self.assertEqual(self.div_json(div), self.div_json(exp))
+
+    def test_convert_dict_plotly_fig_html_div_parallel_cache(self):
+        df = px.data.gapminder().query("country=='Canada'")
+        figs = [px.line(df, x="year", y=y) for y in ['lifeExp', 'pop', 'gdpPercap']]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = jinjautils.HtmlFragmentCache(tmpdir)
+            expected = jinjautils.plhtml(go.Figure(figs[0]), cache=cache)
+            self.assertEqual(cache.stats()['misses'], 1)
+
+            # lookups and stores are made in this process, workers only render the misses
+            data = {'ch1': go.Figure(figs[0]), 'innerd': {'ch2': go.Figure(figs[1]), 'ch3': go.Figure(figs[2])}}
+            res = jinjautils.convert_dict_plotly_fig_html_div(data, n_jobs=2, cache=cache)
+            self.assertEqual(self.div_json(res['ch1']), self.div_json(expected))
+            self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 3))
+            self.assertEqual(len([x for x in os.listdir(tmpdir) if x.endswith('.html')]), 3)
+
+            data = {'ch1': go.Figure(figs[1]), 'ch2': go.Figure(figs[2])}
+            jinjautils.convert_dict_plotly_fig_html_div(data, n_jobs=2, cache=cache)
+            self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (3, 3))
+
+    @staticmethod
+    def div_json(div):
+        return div[div.index('Plotly.newPlot('):].split(',', 1)[1]
+
+    def test_render_html_stream(self):
+        df = px.data.gapminder().query("country=='Canada'")
+        fig = px.line(df, x="year", y="lifeExp")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, 'page.html'), 'w') as fh:
+                fh.write('<title>{{ pagetitle }}</title>{{ data.ch1 }}{{ data.sub.ch2 }}')
+
+            renderer = jinjautils.HtmlRenderer(template_dir=tmpdir)
+            expected = renderer.render({'name': 'test', 'ch1': go.Figure(fig), 'sub': {'ch2': go.Figure(fig)}},
+                                       'page.html')
+
+            data = {'name': 'test', 'ch1': go.Figure(fig), 'sub': {'ch2': go.Figure(fig)}}
+            filename = os.path.join(tmpdir, 'out.html')
+            res = jinjautils.render_html(data, os.path.join(tmpdir, 'page.html'), filename, stream=True)
+            self.assertEqual(res, filename)
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['out.html', 'page.html'])  # no temp file left behind
+            self.assertIsNone(data['ch1'].fig)  # figures released once written
+
+            with open(filename, encoding='utf8') as fh:
+                output = fh.read()
+            self.assertTrue(output.startswith('<title>test</title>'))
+            self.assertEqual(output.count('Plotly.newPlot'), 2)
+            self.assertEqual(len(output), len(expected))
+
+    def test_image_exporter_cache(self):
+        df = px.data.gapminder().query("country=='Canada'")
+        fig = px.line(df, x="year", y="lifeExp")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            exporter = jinjautils.ImageExporter(cache_dir=tmpdir, width=600)
+            opts = dict(format='png', width=600, height=None, scale=None)
+            key = jinjautils.json_hash(go.Figure(fig).to_json(), sorted(opts.items()))
+            exporter.cache.put_bytes(key, b'cachedpng')
+
+            # cached images are returned without rasterising
+            data = {'name': 'test', 'sub': {'ch1': go.Figure(fig)}}
+            res = jinjautils.convert_dict_plotly_fig_png(data, exporter=exporter)
+            self.assertEqual(res['sub']['ch1'], jinjautils.img_tag(b'cachedpng'))
+            self.assertEqual(exporter.cache.stats()['hits'], 1)
+
+    @unittest.skipUnless(importlib.util.find_spec('kaleido'), 'requires kaleido for static image export')
+    def test_image_exporter(self):
+        df = px.data.gapminder().query("country=='Canada'")
+        fig = px.line(df, x="year", y="lifeExp")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with jinjautils.ImageExporter(n_jobs=2, cache_dir=tmpdir) as exporter:
+                images = exporter.to_images([go.Figure(fig), go.Figure(fig)])
+                self.assertTrue(images[0].startswith(b'\x89PNG'))
+                exporter.to_images([go.Figure(fig)])
+                self.assertEqual(exporter.cache.stats()['hits'], 1)
+
+    def test_plhtml_binary(self):
+        dr = pd.date_range('2020-01-01', periods=500)
+        y = np.linspace(0, 1, len(dr))
+        y[10] = np.nan
+        fig = go.Figure(go.Scatter(x=dr, y=y))
+
+        res = jinjautils.encode_fig_arrays(fig)
+        trace = res['data'][0]
+        self.assertEqual(trace['x'][0], '2020-01-01')
+        self.assertEqual(trace['y']['dtype'], 'f8')
+        np.testing.assert_array_equal(np.frombuffer(base64.b64decode(trace['y']['bdata']), dtype='<f8'), y)
+
+        trace = jinjautils.encode_fig_arrays(fig, float32=True)['data'][0]
+        self.assertEqual(trace['y']['dtype'], 'f4')
+
+        self.assertEqual(jinjautils.encode_array(['a', 'b']), ['a', 'b'])
+        self.assertEqual(jinjautils.encode_array([1, None, 3])['dtype'], 'f8')
+
+        default = jinjautils.plhtml(go.Figure(fig))
+        binary = jinjautils.plhtml(go.Figure(fig), binary=True)
+        self.assertIn('"bdata"', binary)
+        self.assertLess(len(binary), len(default) * 0.8)
+
+    def test_render_html_lazy(self):
+        df = px.data.gapminder().query("country=='Canada'")
+        fig = px.line(df, x="year", y="lifeExp", title='</script>')
+
+        div = jinjautils.plhtml(go.Figure(fig), lazy=True)
+        self.assertNotIn('Plotly.newPlot', div)
+        divid = div.split('"')[1]
+        payload = div[div.index('>', div.index('{}-data'.format(divid))) + 1:div.rindex('</script>')]
+        self.assertEqual(json.loads(payload)['layout']['title']['text'], '</script>')
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'test.html')
+            jinjautils.render_html({'name': 'test', 'ch1': go.Figure(fig)}, 'base.html', filename,
+                                   package_loader_name='commodplot', lazy=True)
+            with open(filename, encoding='utf8') as fh:
+                output = fh.read()
+            self.assertEqual(output.count('IntersectionObserver('), 1)
+
+            jinjautils.render_html({'name': 'test'}, 'base.html', filename, package_loader_name='commodplot')
+            with open(filename, encoding='utf8') as fh:
+                self.assertNotIn('IntersectionObserver', fh.read())
+
+    def test_render_thunks(self):
+        df = px.data.gapminder().query("country=='Canada'")
+        built = []
+
+        def chart(name):
+            def build():
+                built.append(name)
+                return px.line(df, x="year", y="lifeExp", title=name)
+            return build
+
+        async def title():
+            return 'async title'
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, 'page.html'), 'w') as fh:
+                fh.write('{{ data.title }}{% if show %}{{ data.ch1 }}{% endif %}{{ data.sub["ch2"] }}{{ missing }}')
+
+            renderer = jinjautils.HtmlRenderer(template_dir=tmpdir)
+            for thunk_jobs in [None, 2]:
+                built.clear()
+                data = {'name': 'test', 'title': title(), 'ch1': chart('ch1'), 'sub': {'ch2': chart('ch2')},
+                        'unused': chart('unused')}
+                res = renderer.render(data, 'page.html', template_globals={'show': False}, thunk_jobs=thunk_jobs)
+                self.assertTrue(res.startswith('async title'))
+                self.assertEqual(res.count('Plotly.newPlot'), 1)
+                self.assertEqual(sorted(built), ['ch2'] if thunk_jobs is None else ['ch1', 'ch2'])  # prefetch is static
+
+            self.assertEqual(jinjautils.referenced_data_paths(renderer.env, 'page.html'),
+                             {('title',), ('ch1',), ('sub',), ('sub', 'ch2')})
+
+            # charts returned by thunks follow the render's lazy option, whether or not prefetched
+            for kwargs in [{}, {'thunk_jobs': 2}]:
+                data = {'name': 'test', 'title': 'title', 'sub': {'ch2': chart('ch2')}}
+                res = renderer.render(data, 'page.html', lazy=True, **kwargs)
+                self.assertNotIn('Plotly.newPlot', res)
+                self.assertIn('-data', res)
+
+            filename = os.path.join(tmpdir, 'out.html')
+            data = {'name': 'test', 'title': 'title', 'sub': {'ch2': chart('ch2')}}
+            jinjautils.render_html(data, os.path.join(tmpdir, 'page.html'), filename, stream=True, lazy=True)
+            with open(filename, encoding='utf8') as fh:
+                self.assertNotIn('Plotly.newPlot', fh.read())
+
+    def test_render_html_compress(self):
+        df = px.data.gapminder().query("country=='Canada'")
+        fig = px.line(df, x="year", y="lifeExp")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, 'page.html'), 'w') as fh:
+                fh.write('<title>{{ pagetitle }}</title>{{ data.ch1 }}')
+
+            for stream in [False, True]:
+                filename = os.path.join(tmpdir, 'out.html')
+                jinjautils.render_html({'name': 'test', 'ch1': go.Figure(fig)}, os.path.join(tmpdir, 'page.html'),
+                                       filename, stream=stream, compress=['gz'])
+                with open(filename, 'rb') as fh, gzip.open(filename + '.gz') as gz:
+                    self.assertEqual(fh.read(), gz.read())
+                self.assertEqual(sorted(os.listdir(tmpdir)), ['out.html', 'out.html.gz', 'page.html'])
+
+            if jinjautils.brotli is None:
+                with self.assertRaises(ImportError):
+                    jinjautils.PageWriter(filename, compress='br')
+
+    def test_async_renderer(self):
+        df = px.data.gapminder().query("country=='Canada'")
+        fig = px.line(df, x="year", y="lifeExp")
+
+        async def title(delay=0):
+            await asyncio.sleep(delay)
+            return 'async title'
+
+        async def run(tmpdir):
+            renderer = jinjautils.AsyncRenderer(max_concurrency=2)
+            template = os.path.join(tmpdir, 'page.html')
+            pages = [renderer.render({'name': 'test', 'title': title(), 'ch1': go.Figure(fig)}, template)
+                     for i in range(3)]
+            res = await asyncio.gather(*pages, renderer.plhtml(go.Figure(fig)))
+            for page in res[:3]:
+                self.assertTrue(page.startswith('async title'))
+                self.assertEqual(page.count('Plotly.newPlot'), 1)
+            self.assertIn('Plotly.newPlot', res[3])
+
+            # cancelled renders write nothing
+            filename = os.path.join(tmpdir, 'out.html')
+            task = asyncio.ensure_future(renderer.render_html({'name': 'test', 'title': title(10)}, template, filename))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertFalse(os.path.exists(filename))
+
+            # cancelled during the (slow) write
+            started = threading.Event()
+            write = jinjautils.PageWriter.write
+
+            def slow_write(writer, chunk):
+                started.set()
+                time.sleep(0.3)
+                write(writer, chunk)
+
+            with mock.patch.object(jinjautils.PageWriter, 'write', slow_write):
+                task = asyncio.ensure_future(renderer.render_html({'name': 'test', 'title': title()}, template,
+                                                                  filename, compress='gz'))
+                while not started.is_set():
+                    await asyncio.sleep(0.01)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                await asyncio.sleep(0.5)
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['page.html'])
+
+            await renderer.render_html({'name': 'test', 'title': title()}, template, filename)
+            self.assertTrue(os.path.exists(filename))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, 'page.html'), 'w') as fh:
+                fh.write('{{ data.title }}{{ data.ch1 }}')
+            asyncio.run(run(tmpdir))
+
+    def test_fragment_cache(self):
+        df = px.data.gapminder().query("country=='Canada'")
+        fig = px.line(df, x="year", y="lifeExp")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = jinjautils.HtmlFragmentCache(tmpdir)
+            div1 = jinjautils.plhtml(go.Figure(fig), cache=cache)
+            div2 = jinjautils.plhtml(go.Figure(fig), cache=cache)
+            self.assertEqual(cache.stats()['misses'], 1)
+            self.assertEqual(cache.stats()['hits'], 1)
+            self.assertEqual(cache.hit_ratio(), 0.5)
+            self.assertEqual(self.div_json(div1), self.div_json(div2))
+            self.assertNotEqual(div1, div2)  # each div gets its own id
+
+            jinjautils.plhtml(go.Figure(fig), margin={'l': 0}, cache=cache)  # different margin is a new entry
+            self.assertEqual(cache.stats()['misses'], 2)
+
+            # size based eviction keeps the most recent fragment only
+            small = jinjautils.HtmlFragmentCache(tmpdir, maxbytes=int(cache.currbytes * 0.75))
+            small.put('a', div1)
+            self.assertEqual([x for x in os.listdir(tmpdir) if x.endswith('.html')], ['a.html'])
+
     def test_render_html(self):
         dirname, filename = os.path.split(os.path.abspath(__file__))
         test_out_loc = os.path.join(dirname, 'test.html')
@@ -36,6 +327,31 @@ class TestCommodPlotUtil(unittest.TestCase):
         if os.path.exists(test_out_loc):
             os.remove(test_out_loc)
 
+    def test_html_renderer(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, 'page.html'), 'w') as fh:
+                fh.write('{% extends "base.html" %}{% block content %}{{ greeting }} {{ data.ch1 }}{% endblock %}')
+            with open(os.path.join(tmpdir, 'base.html'), 'w') as fh:
+                fh.write('<title>{{ pagetitle }}</title>{% block content %}{% endblock %}')
+
+            cache_dir = os.path.join(tmpdir, 'cache')
+            renderer = jinjautils.HtmlRenderer(template_dir=tmpdir, bytecode_cache_dir=cache_dir,
+                                               template_globals={'greeting': 'hello'})
+            res = renderer.render({'name': 'test', 'ch1': None}, 'page.html')
+            self.assertEqual(res, '<title>test</title>hello ')
+            self.assertTrue(len(os.listdir(cache_dir)) > 0)
+            self.assertIs(renderer.env.get_template('page.html'), renderer.env.get_template('page.html'))
+
+            res = renderer.render({'name': 'test', 'ch1': 'x'}, 'page.html', template_globals={'greeting': 'bye'})
+            self.assertEqual(res, '<title>test</title>bye x')
+
+            # a new renderer sharing the bytecode cache renders the same page
+            renderer = jinjautils.HtmlRenderer(template_dir=tmpdir, bytecode_cache_dir=cache_dir)
+            out = os.path.join(tmpdir, 'out.html')
+            renderer.render_html({'name': 'test', 'ch1': 'x'}, 'page.html', out, template_globals={'greeting': 'hi'})
+            with open(out, encoding='utf8') as fh:
+                self.assertEqual(fh.read(), '<title>test</title>hi x')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,249 @@
+import os
+import re
+import socketserver
+import tempfile
+import threading
+import unittest
+from queue import Full
+from smtplib import SMTPException, SMTPResponseException, SMTPServerDisconnected
+
+import plotly.graph_objects as go
+
+from commodplot import jinjautils
+from commodplot import messaging
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server: records messages, optionally fails the first DATA commands with 451."""
+
+    def send(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.send("220 fake smtp")
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                return
+            command = line.split(" ")[0].upper()
+            if command in ["EHLO", "HELO"]:
+                self.send("250 fake")
+            elif command == "MAIL":
+                sender, recipients = line, []
+                self.send("250 ok")
+            elif command == "RCPT":
+                address = line.split(":", 1)[1].strip("<> ")
+                if address.endswith("@refused.local"):
+                    self.send("550 no such user")
+                else:
+                    recipients.append(address)
+                    self.send("250 ok")
+            elif command == "DATA":
+                with server.lock:
+                    fail = server.fail_data > 0
+                    server.fail_data -= 1
+                if fail:
+                    self.send("451 try again later")
+                    continue
+                self.send("354 go ahead")
+                data = []
+                while True:
+                    line = self.rfile.readline().decode()
+                    if line.rstrip("\r\n") == ".":
+                        break
+                    data.append(line)
+                with server.lock:
+                    server.messages.append((recipients, "".join(data)))
+                self.send("250 queued")
+            elif command in ["RSET", "NOOP"]:
+                self.send("250 ok")
+            elif command == "QUIT":
+                self.send("221 bye")
+                return
+            else:
+                self.send("502 not implemented")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, fail_data=0):
+        super().__init__(("127.0.0.1", 0), FakeSMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.fail_data = fail_data
+        self.messages = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def report(i, to=None):
+    return (
+        messaging.EmailBuilder()
+        .set_sender("reports@energy.local")
+        .set_receiver(to or f"desk{i}@energy.local")
+        .set_subject(f"Report {i}")
+        .set_body(f"<p>report {i}</p>")
+    )
+
+
+class TestMessaging(unittest.TestCase):
+    def setUp(self):
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.close()
+
+    def sender(self, fail_data=0, **kwargs):
+        self.server = FakeSMTPServer(fail_data=fail_data)
+        host, port = self.server.server_address
+        return messaging.BatchSender(host, port, timeout=5, starttls=False, backoff=0.01, **kwargs)
+
+    def test_batch_sender_reuses_connections(self):
+        sender = self.sender(pool_size=2)
+        results = sender.send([report(i) for i in range(20)])
+
+        self.assertTrue(all(x.ok for x in results))
+        self.assertEqual([x.index for x in results], list(range(20)))
+        self.assertEqual(len(self.server.messages), 20)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_batch_sender_retries(self):
+        sender = self.sender(fail_data=2, max_retries=3)
+        results = sender.send([report(0), report(1, to="desk@energy.local, nobody@refused.local"),
+                               report(2, to="nobody@refused.local")])
+
+        self.assertTrue(results[0].ok)
+        self.assertEqual(results[0].attempts, 3)  # two 451s then delivered
+        self.assertTrue(results[1].ok)
+        self.assertEqual(list(results[1].refused), ["nobody@refused.local"])
+        self.assertFalse(results[2].ok)  # permanent failure, not retried
+        self.assertEqual(results[2].attempts, 1)
+        self.assertIn("SMTPRecipientsRefused", results[2].error)
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_batch_sender_bcc(self):
+        sender = self.sender()
+        message = report(0).set_bcc("hidden@energy.local")
+        results = sender.send([message])
+
+        self.assertTrue(results[0].ok)
+        recipients, data = self.server.messages[0]
+        self.assertEqual(recipients, ["desk0@energy.local", "hidden@energy.local"])
+        self.assertNotIn("hidden@energy.local", data)
+        self.assertIn("Bcc: hidden@energy.local", message.build())  # the message itself is unchanged
+
+    def test_batch_sender_keeps_connection_after_smtp_errors(self):
+        sender = self.sender(fail_data=1, pool_size=1, max_retries=2)
+        results = sender.send([report(0), report(1, to="nobody@refused.local"), report(2)])
+
+        self.assertEqual([x.ok for x in results], [True, False, True])
+        self.assertEqual(results[0].attempts, 2)
+        self.assertEqual(self.server.connections, 1)  # response errors do not drop the connection
+
+    def test_is_transient(self):
+        self.assertTrue(messaging.is_transient(SMTPServerDisconnected()))
+        self.assertTrue(messaging.is_transient(ConnectionResetError()))
+        self.assertTrue(messaging.is_transient(SMTPResponseException(451, "try again")))
+        self.assertFalse(messaging.is_transient(SMTPResponseException(554, "rejected")))
+        self.assertFalse(messaging.is_transient(SMTPException("no suitable auth method")))
+
+    def test_email_queue(self):
+        sender = self.sender(pool_size=2)
+        with tempfile.TemporaryDirectory() as spool:
+            with messaging.EmailQueue(sender, maxsize=5, workers=2, batch_size=4, spool_dir=spool) as queue:
+                for i in range(30):  # more than maxsize, put waits for the workers
+                    queue.put(report(i))
+                queue.flush()
+                metrics = queue.metrics()
+                self.assertEqual(metrics["sent"], 30)
+                self.assertEqual(metrics["pending"], 0)
+                self.assertEqual(os.listdir(spool), [])  # delivered messages leave the spool
+            self.assertEqual(len(self.server.messages), 30)
+
+    def test_email_queue_spool(self):
+        with tempfile.TemporaryDirectory() as spool:
+            # relay down: messages stay spooled
+            down = messaging.BatchSender("127.0.0.1", 1, timeout=1, starttls=False, max_retries=0)
+            with messaging.EmailQueue(down, spool_dir=spool) as queue:
+                queue.put(report(0))
+                queue.put(report(1))
+            self.assertEqual(queue.metrics()["failed"], 2)
+            self.assertEqual(len(os.listdir(spool)), 2)
+
+            # and are delivered after a restart
+            with messaging.EmailQueue(self.sender(), spool_dir=spool) as queue:
+                queue.flush()
+                self.assertEqual(queue.metrics()["sent"], 2)
+            self.assertEqual(os.listdir(spool), [])
+            self.assertEqual(len(self.server.messages), 2)
+
+    def test_email_queue_full(self):
+        with tempfile.TemporaryDirectory() as spool:
+            down = messaging.BatchSender("127.0.0.1", 1, timeout=1, starttls=False, max_retries=0)
+            with messaging.EmailQueue(down, maxsize=1, workers=0, spool_dir=spool) as queue:
+                queue.put(report(0))
+                with self.assertRaises(Full):
+                    queue.put(report(1), block=False)
+                self.assertEqual(len(os.listdir(spool)), 1)  # the rejected message is not left spooled
+                self.assertEqual((queue.metrics()["enqueued"], queue.metrics()["spooled"]), (1, 1))
+
+    def test_report_email(self):
+        fig = go.Figure(go.Scatter(x=[1, 2, 3], y=[2, 1, 3]), layout={"title": "Crude"})
+        png = b"\x89PNG\r\n\x1a\n"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            template = os.path.join(tmpdir, "report.html")
+            with open(template, "w") as fh:
+                fh.write("<h1>{{ pagetitle }}</h1>{{ data.ch1 }}{{ data.sub.ch2 }}")
+
+            # images come from the exporter's cache, large at full size and smaller when downscaled
+            exporter = jinjautils.ImageExporter(cache_dir=os.path.join(tmpdir, "cache"))
+            for scale, size in [(None, 60000), (0.5, 20000)]:
+                key = jinjautils.json_hash(
+                    go.Figure(fig).to_json(), sorted(dict(format="png", width=None, height=None, scale=scale).items())
+                )
+                exporter.cache.put_bytes(key, png + b"0" * size)
+
+            def data():
+                return {"name": "Report", "ch1": go.Figure(fig), "sub": {"ch2": go.Figure(fig)}}
+
+            message, summary = messaging.report_email(data(), template, exporter=exporter, scales=(None,))
+            self.assertEqual(summary["images"], 2)
+            body = message.build()
+            content_ids = re.findall(r'src="cid:([^"]+)"', body)
+            self.assertEqual(len(content_ids), 2)
+            for content_id in content_ids:
+                self.assertIn(f"Content-ID: <{content_id}>", body)
+            self.assertNotIn("data:image", body)
+
+            # over budget: downscaled
+            message, summary = messaging.report_email(data(), template, exporter=exporter, max_bytes=100000,
+                                                      scales=(None, 0.5))
+            self.assertEqual((summary["scale"], summary["images"], summary["dropped"]), (0.5, 2, 0))
+
+            # still over budget at the smallest scale: the largest image is dropped
+            message, summary = messaging.report_email(data(), template, exporter=exporter, max_bytes=40000,
+                                                      scales=(None, 0.5))
+            self.assertEqual((summary["images"], summary["dropped"]), (1, 1))
+            self.assertIn("Chart omitted", message.build())
+            self.assertLessEqual(len(message.build()), 40000)
+
+    def test_message_addresses(self):
+        message = report(0, to="a@energy.local, B <b@energy.local>").set_bcc("c@energy.local")
+        self.assertEqual(
+            messaging.message_addresses(message),
+            ("reports@energy.local", ["a@energy.local", "b@energy.local", "c@energy.local"]),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()